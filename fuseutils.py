@@ -31,6 +31,17 @@ import errno
 import functools
 import logging
 import fuse
+import collections
+import cProfile
+import pstats
+import re
+import socket
+import sys
+import threading
+import time
+import traceback
+import types
+import urllib
 
 
 def flag2mode(flags):
@@ -67,14 +78,17 @@ class LoggerMetaclass(type):
                 f(self, *args, **kwargs)
             dict['__init__'] = __init__wrapper
         else:
-            # The class has no __init__ defined, so define one
+            # The class has no __init__ defined, so define one. This must
+            # name the class being created rather than self.__class__, which
+            # would recurse forever for instances of a subclass.
             def __init__(self, *args, **kwargs):
                 if not hasattr(self, 'logger'):
                     self.logger = logging.getLogger(name)
-                super(self.__class__, self).__init__(*args, **kwargs)
+                super(cls, self).__init__(*args, **kwargs)
             dict['__init__'] = __init__
         
-        return type.__new__(mcs, name, bases, dict)
+        cls = type.__new__(mcs, name, bases, dict)
+        return cls
 
 
 class FileProxy(object):
@@ -185,3 +199,325 @@ class Stat(fuse.Stat):
         for attr in self.st_attrs:
             setattr(self, attr, getattr(copy_stat, attr, None))
 
+
+
+class Profiler(object):
+    """ Profiler which can be turned on for a while in a running filesystem.
+    
+        Functions decorated with profiled() are timed, and the outermost one
+        on each thread is run under cProfile, while a sampling thread records
+        the stacks of all threads, including those created by fuse. Only one
+        cProfile can run per thread, so the profile of the nested ones is
+        taken from the outer profiles they ran under.
+    """
+    __metaclass__ = LoggerMetaclass
+    SAMPLE_INTERVAL_SECS = 0.01
+    POLL_SECS = 1.
+    
+    def __init__(self):
+        self.active = False
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.functions = {}
+        self.counters = {}
+        self._reset()
+    
+    def _reset(self):
+        self.timings = {}
+        self.stats = {}
+        self.nested = set()
+        self.samples = collections.defaultdict(int)
+    
+    def profiled(self, name):
+        """ Decorator to profile calls to a function under name. """
+        def decorator(f):
+            code = f.func_code
+            self.functions[name] = (code.co_filename, code.co_firstlineno,
+                                    code.co_name)
+            @functools.wraps(f)
+            def wrapper(*args, **kwargs):
+                if not self.active:
+                    return f(*args, **kwargs)
+                return self._call(name, f, args, kwargs)
+            return wrapper
+        return decorator
+    
+    def add_counters(self, name, func):
+        """ Have the counters returned in a dict by func written to the
+            results under name. """
+        self.counters[name] = func
+    
+    def _call(self, name, f, args, kwargs):
+        def call():
+            result = f(*args, **kwargs)
+            # Generators (eg. readdir) do their work when iterated
+            if isinstance(result, types.GeneratorType):
+                result = iter(list(result))
+            return result
+        
+        # Only one cProfile can be enabled per thread, so nested calls are
+        # just timed and show up in the outer call's profile.
+        prof = None
+        if not getattr(self.local, 'profiling', False):
+            prof = cProfile.Profile()
+            self.local.profiling = True
+        else:
+            self.nested.add(name)
+        
+        start = time.time()
+        try:
+            if prof:
+                return prof.runcall(call)
+            return call()
+        finally:
+            elapsed = time.time() - start
+            if prof:
+                self.local.profiling = False
+            with self.lock:
+                timing = self.timings.setdefault(name, [0, 0., 0.])
+                timing[0] += 1
+                timing[1] += elapsed
+                timing[2] = max(timing[2], elapsed)
+                if prof:
+                    if name in self.stats:
+                        self.stats[name].add(prof)
+                    else:
+                        self.stats[name] = pstats.Stats(prof)
+    
+    def start(self, secs, outdir):
+        """ Profile for secs seconds in a background thread, then write the
+            results to a new directory under outdir. Returns False if
+            already profiling. """
+        with self.lock:
+            if self.active:
+                return False
+            self._reset()
+            self.active = True
+        
+        t = threading.Thread(target=self._session, args=(secs, outdir),
+                             name='profiler')
+        t.setDaemon(True)
+        t.start()
+        return True
+    
+    def watch(self, ctlpath, outdir, default_secs=30):
+        """ Start a thread which polls for ctlpath to be created, and then
+            profiles for the number of seconds written in it. """
+        def poll():
+            while True:
+                time.sleep(self.POLL_SECS)
+                if not os.path.exists(ctlpath):
+                    continue
+                try:
+                    secs = float(open(ctlpath).read().strip() or default_secs)
+                except (IOError, ValueError):
+                    self.logger.exception('Bad profile control file %s', ctlpath)
+                    secs = default_secs
+                try:
+                    os.unlink(ctlpath)
+                except OSError:
+                    pass
+                self.start(secs, outdir)
+        
+        t = threading.Thread(target=poll, name='profile-watcher')
+        t.setDaemon(True)
+        t.start()
+        return t
+    
+    def _session(self, secs, outdir):
+        try:
+            dumpdir = os.path.join(outdir, '%s.%s.%s' % (
+                time.strftime('%Y%m%d-%H%M%S'), socket.gethostname(),
+                os.getpid()))
+            os.makedirs(dumpdir)
+            self.logger.warning('profiling for %ss into %s', secs, dumpdir)
+            
+            stacks = open(os.path.join(dumpdir, 'stacks.txt'), 'w')
+            self._dump_stacks(stacks, 'start')
+            
+            me = threading.current_thread().ident
+            deadline = time.time() + secs
+            while time.time() < deadline:
+                names = self._thread_names()
+                for ident, frame in sys._current_frames().items():
+                    if ident == me:
+                        continue
+                    key = [names.get(ident, str(ident))]
+                    key.extend(['%s:%s' % (os.path.basename(f[0]), f[2])
+                                    for f in traceback.extract_stack(frame)])
+                    self.samples[';'.join(key)] += 1
+                time.sleep(self.SAMPLE_INTERVAL_SECS)
+        except Exception, e:
+            self.logger.exception('Exception while profiling')
+            self.active = False
+            return
+        
+        with self.lock:
+            self.active = False
+        
+        try:
+            self._dump_stacks(stacks, 'end')
+            stacks.close()
+            self._write_results(dumpdir)
+            self.logger.warning('profile written to %s', dumpdir)
+        except Exception, e:
+            self.logger.exception('Exception while writing profile')
+    
+    def _write_results(self, dumpdir):
+        # Collapsed stacks, one per line followed by the sample count, as
+        # used by flamegraph tools.
+        f = open(os.path.join(dumpdir, 'samples.txt'), 'w')
+        for stack, count in sorted(self.samples.items()):
+            f.write('%s %d\n' % (stack, count))
+        f.close()
+        
+        f = open(os.path.join(dumpdir, 'timings.txt'), 'w')
+        f.write('%-32s %8s %12s %12s %12s\n' % ('name', 'calls', 'total', 'mean', 'max'))
+        for name, (count, total, maxtime) in sorted(self.timings.items(),
+                                                    key=lambda i: -i[1][1]):
+            f.write('%-32s %8d %12.6f %12.6f %12.6f\n' % (
+                        name, count, total, total/count, maxtime))
+        f.close()
+        
+        f = open(os.path.join(dumpdir, 'counters.txt'), 'w')
+        for name, func in sorted(self.counters.items()):
+            for key, value in sorted(func().items()):
+                f.write('%s.%s %s\n' % (name, key, value))
+        f.close()
+        
+        # Load these with pstats
+        profpaths = []
+        for name, stats in self.stats.items():
+            profpaths.append(os.path.join(dumpdir, '%s.prof' % name))
+            stats.dump_stats(profpaths[-1])
+        if not profpaths:
+            return
+        
+        # Report what the outer profiles recorded of the functions called
+        # nested in them, ie. their totals, callees and callers.
+        combined = pstats.Stats(*profpaths)
+        combined.sort_stats('cumulative')
+        for name in self.nested:
+            func = self.functions[name]
+            if func not in combined.stats:
+                continue
+            restriction = re.escape(pstats.func_std_string(func))
+            combined.stream = open(os.path.join(dumpdir, '%s.txt' % name), 'w')
+            combined.print_stats(restriction)
+            combined.print_callees(restriction)
+            combined.print_callers(restriction)
+            combined.stream.close()
+    
+    def _thread_names(self):
+        return dict([(t.ident, t.name) for t in threading.enumerate()])
+    
+    def _dump_stacks(self, f, when):
+        names = self._thread_names()
+        f.write('=== Threads at %s (%s)\n' % (when, time.ctime()))
+        for ident, frame in sys._current_frames().items():
+            f.write('\n--- %s (%s)\n' % (names.get(ident, '<fuse thread>'), ident))
+            f.write(''.join(traceback.format_stack(frame)))
+        f.write('\n')
+        f.flush()
+
+
+class Tracer(object):
+    """ Records the filesystem operations received, one per line, as tab
+        separated fields:
+        
+            start  duration  op  fh  path  args  error
+        
+        where start is the number of seconds since recording started, fh
+        identifies the open file for file operations (or is '-'), path is
+        URL quoted so that it cannot contain tabs or newlines, args are the
+        remaining arguments separated by commas and error is the name of the
+        exception raised or the errno returned, if the op failed.
+    """
+    __metaclass__ = LoggerMetaclass
+    
+    def __init__(self):
+        self.file = None
+        self.lock = threading.Lock()
+    
+    def start(self, path):
+        # Set before the file, which turns tracing on
+        self.start_time = time.time()
+        self.file = open(path, 'a')
+        self.logger.info('tracing to %s', path)
+    
+    def stop(self):
+        with self.lock:
+            if self.file:
+                self.file.close()
+                self.file = None
+    
+    def traced(self, op, file_op=False):
+        """ Decorator to trace calls to a filesystem method as op. File ops
+            are methods of an open file, which has the path attribute. """
+        def decorator(f):
+            @functools.wraps(f)
+            def wrapper(self_, *args, **kwargs):
+                if not self.file:
+                    return f(self_, *args, **kwargs)
+                
+                if file_op:
+                    fh, path, rest = id(self_), self_.path, args
+                else:
+                    fh, path, rest = '-', args[0], args[1:]
+                start = time.time()
+                error = 'exception'
+                try:
+                    result = f(self_, *args, **kwargs)
+                    
+                    if isinstance(result, types.GeneratorType):
+                        error = None
+                        return self._trace_generator(result, start, op, fh,
+                                                     path, rest)
+                    if op == 'open':
+                        # The file object is what later file ops are called on
+                        fh = id(result)
+                    error = ''
+                    if isinstance(result, int) and result < 0:
+                        error = errno.errorcode.get(-result, str(-result))
+                    return result
+                except Exception, e:
+                    error = e.__class__.__name__
+                    raise
+                finally:
+                    if error is not None:
+                        self._record(start, op, fh, path, rest, error)
+            return wrapper
+        return decorator
+    
+    def _trace_generator(self, gen, start, op, fh, path, args):
+        error = 'exception'
+        try:
+            for item in gen:
+                yield item
+            error = ''
+        except Exception, e:
+            error = e.__class__.__name__
+            raise
+        finally:
+            self._record(start, op, fh, path, args, error)
+    
+    def _record(self, start, op, fh, path, args, error=''):
+        end = time.time()
+        line = '%.6f\t%.6f\t%s\t%s\t%s\t%s\t%s\n' % (
+                    start - self.start_time, end - start, op, fh,
+                    urllib.quote(path),
+                    ','.join([str(a) for a in args]), error)
+        with self.lock:
+            if self.file:
+                self.file.write(line)
+                self.file.flush()
+
+
+def read_trace(file):
+    """ Generate (start, duration, op, fh, path, args, error) tuples from a
+        trace written by Tracer. """
+    for line in file:
+        start, duration, op, fh, path, args, error = line.rstrip('\n').split('\t')
+        args = tuple([int(a) for a in args.split(',') if a])
+        yield (float(start), float(duration), op, fh, urllib.unquote(path),
+               args, error)
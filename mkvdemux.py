@@ -0,0 +1,397 @@
+# -*- coding: utf-8 -*-
+
+# Add subtitle files in the same directory as videos containing the subtitles
+# with the same name, but apropriate subtitle extension.
+# Copyright 2011 crass <crass@berlios.de>
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#   1. Redistributions of source code must retain the above copyright notice,
+#      this list of conditions and the following disclaimer.
+#   2. Redistributions in binary form must reproduce the above copyright notice,
+#      this list of conditions and the following disclaimer in the documentation
+#      and/or other materials provided with the distribution.
+#   3. The name of the author may not be used to endorse or promote products
+#      derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR ``AS IS'' AND ANY EXPRESS OR IMPLIED
+# WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO
+# EVENT SHALL THE AUTHOR BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS;
+# OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR
+# OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+# ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import struct
+import zlib
+
+# Element IDs, including their length marker bits as written in the spec
+EBML = 0x1A45DFA3
+SEGMENT = 0x18538067
+SEEK_HEAD = 0x114D9B74
+INFO = 0x1549A966
+TIMECODE_SCALE = 0x2AD7B1
+TRACKS = 0x1654AE6B
+TRACK_ENTRY = 0xAE
+TRACK_NUMBER = 0xD7
+CODEC_ID = 0x86
+CODEC_PRIVATE = 0x63A2
+DEFAULT_DURATION = 0x23E383
+CONTENT_ENCODINGS = 0x6D80
+CONTENT_ENCODING = 0x6240
+CONTENT_ENCODING_ORDER = 0x5031
+CONTENT_ENCODING_SCOPE = 0x5032
+CONTENT_ENCODING_TYPE = 0x5033
+CONTENT_COMPRESSION = 0x5034
+CONTENT_COMP_ALGO = 0x4254
+CONTENT_COMP_SETTINGS = 0x4255
+CLUSTER = 0x1F43B675
+TIMECODE = 0xE7
+SIMPLE_BLOCK = 0xA3
+BLOCK_GROUP = 0xA0
+BLOCK = 0xA1
+BLOCK_DURATION = 0x9B
+CUES = 0x1C53BB6B
+ATTACHMENTS = 0x1941A469
+CHAPTERS = 0x1043A770
+TAGS = 0x1254C367
+
+# Elements found at the top level of a segment, which end a cluster written
+# with an unknown size (as done when muxing live).
+TOP_LEVEL_IDS = (SEEK_HEAD, INFO, TRACKS, CLUSTER, CUES, ATTACHMENTS,
+                 CHAPTERS, TAGS)
+
+DEFAULT_TIMECODE_SCALE = 1000000    # ns
+ZLIB, HEADER_STRIPPING = 0, 3
+BLOCK_HEADER = struct.Struct('>hB') # timecode relative to cluster, flags
+LACING_FLAGS = 0x06
+
+
+def srt_time(ms):
+    s, ms = divmod(ms, 1000)
+    m, s = divmod(s, 60)
+    h, m = divmod(m, 60)
+    return '%02d:%02d:%02d,%03d' % (h, m, s, ms)
+
+def ssa_time(ms):
+    s, ms = divmod(ms, 1000)
+    m, s = divmod(s, 60)
+    h, m = divmod(m, 60)
+    return '%d:%02d:%02d.%02d' % (h, m, s, ms // 10)
+
+
+class SrtWriter(object):
+    """ Writes subtitle events in the SubRip format. """
+    
+    def __init__(self, out, codec_private):
+        self.out = out
+        self.count = 0
+    
+    def write(self, start, end, data):
+        self.count += 1
+        text = data.replace('\r\n', '\n').rstrip('\n')
+        self.out.write('%d\n%s --> %s\n%s\n\n' % (
+                        self.count, srt_time(start), srt_time(end), text))
+
+
+class SsaWriter(object):
+    """ Writes subtitle events in the SSA or ASS format, after the script
+        header which is kept in the codec private data. Events are written
+        in the order they are muxed rather than by their ReadOrder, which
+        players don't depend on since they sort events by time. """
+    
+    def __init__(self, out, codec_private):
+        self.out = out
+        header = codec_private.rstrip('\0').replace('\r\n', '\n').rstrip('\n')
+        out.write(header + '\n')
+    
+    def write(self, start, end, data):
+        # Blocks hold the fields of a Dialogue line, preceded by ReadOrder
+        # and without the times.
+        fields = data.replace('\r\n', '\n').rstrip('\n').split(',', 2)
+        if len(fields) < 3:
+            raise ValueError('bad SSA event %r' % data)
+        self.out.write('Dialogue: %s,%s,%s,%s\n' % (
+                        fields[1], ssa_time(start), ssa_time(end), fields[2]))
+
+
+class EbmlReader(object):
+    """ Reads EBML element headers and values from a file, keeping track of
+        the position so that elements can be skipped without reading them. """
+    
+    def __init__(self, file):
+        self.file = file
+        self.pos = file.tell()
+        self.pending = None
+    
+    def read(self, size):
+        data = self.file.read(size)
+        if len(data) < size:
+            raise ValueError('truncated Matroska file')
+        self.pos += size
+        return data
+    
+    def skip(self, size):
+        self.file.seek(size, 1)
+        self.pos += size
+    
+    def read_vint(self, is_id=False):
+        """ Return a variable length integer and its length, or (None, 0) at
+            the end of file. An ID keeps its length marker, and a size with
+            all its bits set means unknown and is returned as None. """
+        first = self.file.read(1)
+        if not first:
+            return None, 0
+        self.pos += 1
+        value = ord(first)
+        mask, length = 0x80, 1
+        while not value & mask:
+            mask >>= 1
+            length += 1
+            if length > 8:
+                raise ValueError('bad EBML integer at %d' % (self.pos - 1))
+        
+        if not is_id:
+            value &= mask - 1
+        unknown = value == mask - 1
+        for c in self.read(length - 1):
+            value = value << 8 | ord(c)
+            unknown = unknown and c == '\xff'
+        if unknown and not is_id:
+            return None, length
+        return value, length
+    
+    def element(self):
+        """ Return the ID and data size of the next element, or (None, None)
+            at the end of file. """
+        if self.pending:
+            header, self.pending = self.pending, None
+            return header
+        id, length = self.read_vint(is_id=True)
+        if id is None:
+            return None, None
+        size, length = self.read_vint()
+        if length == 0:
+            raise ValueError('truncated Matroska file')
+        return id, size
+    
+    def unread(self, id, size):
+        """ Push back an element header, to be returned by element() again. """
+        self.pending = (id, size)
+    
+    def children(self, size):
+        """ Generate the ID and size of the elements within a master element
+            of size, which must be known, leaving them to be read or skipped
+            by the caller. """
+        if size is None:
+            raise ValueError('unsupported element of unknown size at %d' % self.pos)
+        end = self.pos + size
+        while self.pos < end:
+            id, child_size = self.element()
+            if id is None:
+                return
+            yield id, child_size
+    
+    def read_uint(self, size):
+        value = 0
+        for c in self.read(size):
+            value = value << 8 | ord(c)
+        return value
+
+
+class SubtitleDemuxer(object):
+    """ Demuxes a text subtitle track from a Matroska file natively, rather
+        than through mkvextract. Events are written out as each cluster is
+        read, so that a sub can be served while the rest of it is still being
+        demuxed, whereas mkvextract buffers its output until it exits. """
+    WRITERS = {
+        'S_TEXT/UTF8': SrtWriter,
+        'S_TEXT/SSA': SsaWriter,
+        'S_TEXT/ASS': SsaWriter,
+    }
+    
+    def __init__(self, file, tracknum):
+        """ Demux the tracknum'th track (counting from 1) of file. """
+        self.reader = EbmlReader(file)
+        self.tracknum = tracknum
+        self.timecode_scale = DEFAULT_TIMECODE_SCALE
+        self.track = None   # Track number used in blocks
+        self.default_duration = 0
+        self.decoders = []
+        self.writer = None
+    
+    def demux(self, out):
+        """ Write the track to file out in the format of its codec, flushing
+            it after each cluster. Raises ValueError if the file is malformed
+            or the track is not a supported text subtitle. """
+        r = self.reader
+        id, size = r.element()
+        if id != EBML:
+            raise ValueError('not a Matroska file')
+        r.skip(size)
+        while id != SEGMENT:
+            id, size = r.element()
+            if id is None:
+                raise ValueError('no segment in Matroska file')
+            if id != SEGMENT:
+                r.skip(size)
+        
+        end = size is not None and r.pos + size or None
+        while end is None or r.pos < end:
+            id, size = r.element()
+            if id is None:
+                break
+            if id == INFO:
+                for id, size in r.children(size):
+                    if id == TIMECODE_SCALE:
+                        self.timecode_scale = r.read_uint(size)
+                    else:
+                        r.skip(size)
+            elif id == TRACKS:
+                self._read_tracks(size, out)
+            elif id == CLUSTER:
+                if self.writer is None:
+                    raise ValueError('track %d not found' % self.tracknum)
+                self._read_cluster(size)
+                out.flush()
+            else:
+                r.skip(size)
+        if self.writer is None:
+            raise ValueError('track %d not found' % self.tracknum)
+    
+    def _read_tracks(self, size, out):
+        r = self.reader
+        count = 0
+        for id, size in r.children(size):
+            if id != TRACK_ENTRY:
+                r.skip(size)
+                continue
+            count += 1
+            if count != self.tracknum:
+                r.skip(size)
+                continue
+            
+            codec, codec_private = '', ''
+            for id, size in r.children(size):
+                if id == TRACK_NUMBER:
+                    self.track = r.read_uint(size)
+                elif id == CODEC_ID:
+                    codec = r.read(size).rstrip('\0')
+                elif id == CODEC_PRIVATE:
+                    codec_private = r.read(size)
+                elif id == DEFAULT_DURATION:
+                    self.default_duration = r.read_uint(size) // 1000000
+                elif id == CONTENT_ENCODINGS:
+                    self._read_encodings(size)
+                else:
+                    r.skip(size)
+            
+            if codec not in self.WRITERS:
+                raise ValueError('unsupported codec %s' % codec)
+            for decode, scope in self.decoders:
+                if scope & 2:
+                    codec_private = decode(codec_private)
+            self.decoders = [d for d, scope in self.decoders if scope & 1]
+            self.writer = self.WRITERS[codec](out, codec_private)
+    
+    def _read_encodings(self, size):
+        r = self.reader
+        encodings = []
+        for id, size in r.children(size):
+            if id != CONTENT_ENCODING:
+                r.skip(size)
+                continue
+            order, scope, type, algo, settings = 0, 1, 0, ZLIB, ''
+            for id, size in r.children(size):
+                if id == CONTENT_ENCODING_ORDER:
+                    order = r.read_uint(size)
+                elif id == CONTENT_ENCODING_SCOPE:
+                    scope = r.read_uint(size)
+                elif id == CONTENT_ENCODING_TYPE:
+                    type = r.read_uint(size)
+                elif id == CONTENT_COMPRESSION:
+                    for id, size in r.children(size):
+                        if id == CONTENT_COMP_ALGO:
+                            algo = r.read_uint(size)
+                        elif id == CONTENT_COMP_SETTINGS:
+                            settings = r.read(size)
+                        else:
+                            r.skip(size)
+                else:
+                    r.skip(size)
+            
+            if type != 0:
+                raise ValueError('encrypted tracks are not supported')
+            if algo == ZLIB:
+                decode = zlib.decompress
+            elif algo == HEADER_STRIPPING:
+                decode = lambda data, settings=settings: settings + data
+            else:
+                raise ValueError('unsupported compression %d' % algo)
+            encodings.append((order, decode, scope))
+        
+        # Decoding starts from the encoding applied last
+        encodings.sort(reverse=True)
+        self.decoders = [(decode, scope) for order, decode, scope in encodings]
+    
+    def _read_cluster(self, size):
+        r = self.reader
+        end = size is not None and r.pos + size or None
+        cluster_time = 0
+        while end is None or r.pos < end:
+            id, size = r.element()
+            if id is None:
+                break
+            if end is None and id in TOP_LEVEL_IDS:
+                r.unread(id, size)
+                break
+            
+            if id == TIMECODE:
+                cluster_time = r.read_uint(size)
+            elif id == SIMPLE_BLOCK:
+                block = self._read_block(size)
+                if block:
+                    self._write(cluster_time, block, None)
+            elif id == BLOCK_GROUP:
+                block = duration = None
+                for id, size in r.children(size):
+                    if id == BLOCK:
+                        block = self._read_block(size)
+                    elif id == BLOCK_DURATION:
+                        duration = r.read_uint(size)
+                    else:
+                        r.skip(size)
+                if block:
+                    self._write(cluster_time, block, duration)
+            else:
+                r.skip(size)
+    
+    def _read_block(self, size):
+        """ Return the (relative timecode, data) of a block of our track, or
+            None after skipping the block of another track. """
+        r = self.reader
+        track, length = r.read_vint()
+        if track != self.track:
+            r.skip(size - length)
+            return None
+        timecode, flags = BLOCK_HEADER.unpack(r.read(BLOCK_HEADER.size))
+        if flags & LACING_FLAGS:
+            raise ValueError('laced subtitle blocks are not supported')
+        data = r.read(size - length - BLOCK_HEADER.size)
+        for decode in self.decoders:
+            data = decode(data)
+        return timecode, data
+    
+    def _write(self, cluster_time, block, duration):
+        timecode, data = block
+        scale = self.timecode_scale
+        start = (cluster_time + timecode) * scale // 1000000
+        if duration is not None:
+            duration = duration * scale // 1000000
+        else:
+            duration = self.default_duration
+        self.writer.write(start, start + duration, data)
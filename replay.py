@@ -0,0 +1,196 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# Replay a trace of FUSE ops recorded with subtitlefs.py -o trace=FILE by
+# calling SubsFuse directly, and report the throughput and latency.
+# Copyright 2011 crass <crass@berlios.de>
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#   1. Redistributions of source code must retain the above copyright notice,
+#      this list of conditions and the following disclaimer.
+#   2. Redistributions in binary form must reproduce the above copyright notice,
+#      this list of conditions and the following disclaimer in the documentation
+#      and/or other materials provided with the distribution.
+#   3. The name of the author may not be used to endorse or promote products
+#      derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR ``AS IS'' AND ANY EXPRESS OR IMPLIED
+# WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO
+# EVENT SHALL THE AUTHOR BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS;
+# OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR
+# OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+# ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import collections
+import logging
+import optparse
+import Queue
+import sys
+import threading
+import time
+
+import subtitlefs
+from fuseutils import read_trace
+
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return 0.
+    return sorted_values[min(len(sorted_values) - 1,
+                             int(len(sorted_values) * pct / 100.))]
+
+
+class Replayer(object):
+    """ Plays back trace events against a SubsFuse with a number of worker
+        threads. All the ops on an open file go to the same worker, so they
+        happen in the order recorded. """
+    
+    def __init__(self, server, concurrency=1, speedup=1.):
+        self.server = server
+        self.concurrency = concurrency
+        self.speedup = speedup
+        self.logger = logging.getLogger('replay')
+        self.lock = threading.Lock()
+        self.latencies = collections.defaultdict(list)
+        self.errors = collections.defaultdict(int)
+        self.recorded_errors = collections.defaultdict(int)
+        self.max_lag = 0.
+    
+    def run(self, events):
+        queues = [Queue.Queue() for i in xrange(self.concurrency)]
+        workers = [threading.Thread(target=self._work, args=(q,))
+                        for q in queues]
+        for t in workers:
+            t.setDaemon(True)
+            t.start()
+        
+        self.start_time = time.time()
+        for i, (start, duration, op, fh, path, args, error) in enumerate(events):
+            if error:
+                self.recorded_errors[op] += 1
+            if self.speedup:
+                delay = start / self.speedup - (time.time() - self.start_time)
+                if delay > 0:
+                    time.sleep(delay)
+            if fh != '-':
+                q = queues[hash(fh) % self.concurrency]
+            else:
+                q = queues[i % self.concurrency]
+            q.put((start, op, fh, path, args))
+        
+        for q in queues:
+            q.put(None)
+        for t in workers:
+            t.join()
+        self.elapsed = time.time() - self.start_time
+    
+    def _work(self, queue):
+        files = {}
+        while True:
+            event = queue.get()
+            if event is None:
+                break
+            
+            start, op, fh, path, args = event
+            begin = time.time()
+            try:
+                result = self.do_op(files, op, fh, path, args)
+                failed = isinstance(result, int) and result < 0
+            except Exception, e:
+                self.logger.exception('%s %s failed', op, path)
+                failed = True
+            end = time.time()
+            
+            with self.lock:
+                self.latencies[op].append(end - begin)
+                if failed:
+                    self.errors[op] += 1
+                if self.speedup:
+                    self.max_lag = max(self.max_lag, begin - self.start_time
+                                                        - start / self.speedup)
+        
+        for file in files.values():
+            file.release(0)
+    
+    def do_op(self, files, op, fh, path, args):
+        server = self.server
+        if op == 'getattr':
+            return server.getattr(path)
+        elif op == 'readdir':
+            return list(server.readdir(path, *args))
+        elif op == 'readlink':
+            return server.readlink(path)
+        elif op == 'open':
+            if fh in files:
+                files.pop(fh).release(0)
+            file = server.file_class(path, *args)
+            if fh == '-':
+                # The open failed when recorded, so nothing reads from it
+                file.release(0)
+            else:
+                files[fh] = file
+        elif op == 'read':
+            return files[fh].read(*args)
+        else:
+            raise ValueError('Unknown op %s' % op)
+    
+    def report(self, out=sys.stdout):
+        total = sum([len(l) for l in self.latencies.values()])
+        print >> out, '%d ops in %.3fs: %.1f ops/s' % (
+                        total, self.elapsed, total / (self.elapsed or 1.))
+        if self.speedup:
+            print >> out, 'max lag behind trace: %.6fs' % self.max_lag
+        print >> out, '%-10s %8s %8s %8s %10s %10s %10s %10s %10s' % (
+                        'op', 'count', 'errors', 'recorded', 'mean', 'p50',
+                        'p90', 'p99', 'max')
+        for op, latencies in sorted(self.latencies.items()):
+            latencies.sort()
+            print >> out, '%-10s %8d %8d %8d %10.6f %10.6f %10.6f %10.6f %10.6f' % (
+                op, len(latencies), self.errors[op], self.recorded_errors[op],
+                sum(latencies) / len(latencies), percentile(latencies, 50),
+                percentile(latencies, 90), percentile(latencies, 99),
+                latencies[-1])
+
+
+def main():
+    parser = optparse.OptionParser(usage="%prog [options] TRACE")
+    parser.add_option('-r', '--root', metavar='PATH', default='/',
+                      help="root the trace was recorded with [default: %default]")
+    parser.add_option('-l', '--lang', metavar='LANG', default='eng',
+                      help="subtitle language [default: %default]")
+    parser.add_option('--cachedir', metavar='CACHE_DIR', default=subtitlefs.CACHE_DIR,
+                      help="set cache directory [default: %default]")
+    parser.add_option('--use-cache-only', default=False, action='store_true',
+                      help="do not run extracting thread [default: %default]")
+    parser.add_option('-c', '--concurrency', metavar='NUM', type='int', default=1,
+                      help="number of worker threads [default: %default]")
+    parser.add_option('-s', '--speedup', metavar='FACTOR', type='float', default=1.,
+                      help="replay FACTOR times faster than recorded, or as "
+                           "fast as possible if 0 [default: %default]")
+    parser.add_option('--loglevel', metavar='LEVEL', default='warning',
+                      help="set logging to LEVEL [default: %default]")
+    opts, args = parser.parse_args()
+    if len(args) != 1:
+        parser.error('a trace file is required')
+    
+    server = subtitlefs.SubsFuse()
+    server.root = opts.root
+    server.lang = opts.lang
+    server.cachedir = opts.cachedir
+    server.use_cache_only = opts.use_cache_only
+    server.loglevel = opts.loglevel
+    server.setup()
+    server.fsinit()
+    
+    replayer = Replayer(server, opts.concurrency, opts.speedup)
+    replayer.run(list(read_trace(open(args[0]))))
+    replayer.report()
+
+if __name__ == "__main__":
+    main()
@@ -30,12 +30,17 @@
 import errno
 import fuse
 import os
+import Queue
 import re
 import stat
+import struct
+import socket
 import subprocess
 import sys
+import thread
 import threading
 import time
+import zlib
 
 try:
     import sqlite3dbm.sshelve as shelve
@@ -46,7 +51,8 @@ import collections
 import random
 import cStringIO as StringIO
 
-from fuseutils import FileProxy, FuseFile, LoopbackFile, Stat
+from fuseutils import FileProxy, FuseFile, LoopbackFile, Profiler, Stat, Tracer
+from mkvdemux import SubtitleDemuxer
 
 
 _fuse_main = fuse.main
@@ -69,14 +75,53 @@ CACHEDB_NAME = 'subtitlesfs.db'
 CACHE_DIR = '/tmp/.subtitlesfs'
 CACHEDB = os.path.join(CACHE_DIR, CACHEDB_NAME)
 TEMP_DIR = os.path.join(CACHE_DIR, TEMP_NAME)
+CACHE_COMPRESS = False
+CACHE_SHARED = False
+# Named after the host and pid, since the cache directory may be shared
+PROFILE_CTL_NAME = 'profile.%s.%s.ctl'
+PROFILE_NAME = 'profile'
+
+# Profiles FUSE ops and MkvFile methods, once turned on by writing a number
+# of seconds to this daemon's PROFILE_CTL_NAME in the cache directory.
+PROFILER = Profiler()
+# Records the FUSE ops received when a trace file is given, to be played
+# back by replay.py.
+TRACER = Tracer()
+
+# Size reported for a sub while it is being extracted, as its real size is
+# only known once done. It stays the same until then, so the kernel never
+# sees the file change size under a reader. Subs are read with direct_io, so
+# reads are not cut off at this size and end where the sub does.
+EXTRACTING_SIZE = 1024 * 1024
+
+# Compressed cache files start with a header holding the uncompressed size,
+# followed by an index of block offsets so that a read only needs to
+# decompress the blocks covering the requested range.
+# They are named with ZCACHE_SUFFIX appended, so that plain subs can be
+# stat'ed without reading them.
+ZCACHE_SUFFIX = '.z'
+ZCACHE_MAGIC = 'SFZ1'
+ZCACHE_BLOCK_SIZE = 64 * 1024
+ZCACHE_HEADER = struct.Struct('>4sQII') # magic, size, block size, num blocks
+ZCACHE_OFFSET = struct.Struct('>Q')
 
 _os_makedirs = os.makedirs
 def makedirs(dirpath, *args, **kwargs):
     if os.path.isdir(dirpath):
         return
-    return _os_makedirs(dirpath, *args, **kwargs)
+    try:
+        return _os_makedirs(dirpath, *args, **kwargs)
+    except OSError, e:
+        # Another thread or daemon may have created it in the meantime
+        if e.errno != errno.EEXIST or not os.path.isdir(dirpath):
+            raise
 os.makedirs = makedirs
 
+def natural_sort_key(name):
+    """ Key to sort names with numbers in numeric order, eg. so that
+        S01E10 sorts after S01E9. """
+    return [int(c) if c.isdigit() else c.lower() for c in re.split(r'(\d+)', name)]
+
 def executable_in_path(exename):
     for path in os.getenv('PATH', '').split(':'):
         exepath = os.path.join(path, exename)
@@ -90,6 +135,565 @@ def genlines(file):
         yield line
         line = file.readline()
 
+def unique_name(*parts):
+    """ Join parts with a suffix unique to this host, process and thread, so
+        that daemons sharing a cache directory never collide. """
+    return '.'.join([str(p) for p in parts] + [
+                        socket.gethostname(), str(os.getpid()),
+                        str(thread.get_ident())])
+
+def cache_file_path(fullpath):
+    """ Return the path the sub for fullpath is cached at, which has
+        ZCACHE_SUFFIX appended if it is compressed, or None if it is not
+        cached. """
+    if os.path.isfile(fullpath):
+        return fullpath
+    zpath = fullpath + ZCACHE_SUFFIX
+    if os.path.isfile(zpath):
+        return zpath
+    return None
+
+def cache_is_fresh(mkvpath, subpath):
+    """ Return whether the sub cached for subpath is up to date with the
+        mkv, by comparing the mtime the sub was given when cached. """
+    path = cache_file_path(subpath)
+    if path is None:
+        return False
+    # utime only sets microseconds, so allow for the lost precision of
+    # filesystems with nanosecond timestamps.
+    if abs(os.lstat(mkvpath).st_mtime - os.lstat(path).st_mtime) >= 1e-5:
+        return False
+    # A corrupt compressed sub is extracted again
+    return path == subpath or cache_file_size(path) is not None
+
+def write_cache_file(path, data, compress=None, times=None):
+    """ Write subtitle data to the cache for path, compressed with
+        ZCACHE_SUFFIX appended if compress (defaults to CACHE_COMPRESS) is
+        set. The file is written under a temporary name and renamed into
+        place, so readers never see a partial file. """
+    if compress is None:
+        compress = CACHE_COMPRESS
+    
+    cachepath, stalepath = path, path + ZCACHE_SUFFIX
+    if compress:
+        cachepath, stalepath = stalepath, cachepath
+    tmppath = unique_name(path, 'tmp')
+    f = open(tmppath, 'wb')
+    try:
+        try:
+            if compress:
+                blocks = [zlib.compress(data[i:i+ZCACHE_BLOCK_SIZE])
+                            for i in xrange(0, len(data), ZCACHE_BLOCK_SIZE)]
+                f.write(ZCACHE_HEADER.pack(ZCACHE_MAGIC, len(data),
+                                           ZCACHE_BLOCK_SIZE, len(blocks)))
+                # Offsets are relative to the start of the block data, with
+                # an extra one at the end so that every block's length is
+                # known.
+                offset = 0
+                for block in blocks:
+                    f.write(ZCACHE_OFFSET.pack(offset))
+                    offset += len(block)
+                f.write(ZCACHE_OFFSET.pack(offset))
+                for block in blocks:
+                    f.write(block)
+            else:
+                f.write(data)
+        finally:
+            f.close()
+        
+        # Times must be set before publishing, since the mtime is what tells
+        # other readers the sub is up to date.
+        if times:
+            os.utime(tmppath, times)
+        os.rename(tmppath, cachepath)
+    except:
+        if os.path.exists(tmppath):
+            os.unlink(tmppath)
+        raise
+    
+    # Drop the sub cached before the compress option was changed
+    try:
+        os.unlink(stalepath)
+    except OSError, e:
+        if e.errno != errno.ENOENT:
+            raise
+
+def _read_cache_header(file):
+    """ Return (size, block size, block offsets) of the compressed sub in
+        file, leaving it positioned at the block data, or None if the file
+        is truncated or corrupt. """
+    header = file.read(ZCACHE_HEADER.size)
+    if len(header) < ZCACHE_HEADER.size or not header.startswith(ZCACHE_MAGIC):
+        return None
+    
+    # Check the header is consistent with itself and the length of the file
+    magic, size, block_size, nblocks = ZCACHE_HEADER.unpack(header)
+    filesize = os.fstat(file.fileno()).st_size
+    index_size = ZCACHE_OFFSET.size * (nblocks + 1)
+    if block_size == 0 or nblocks != (size + block_size - 1) // block_size \
+            or ZCACHE_HEADER.size + index_size > filesize:
+        return None
+    
+    index = file.read(index_size)
+    offsets = [ZCACHE_OFFSET.unpack_from(index, i*ZCACHE_OFFSET.size)[0]
+                    for i in xrange(nblocks + 1)]
+    if offsets[0] != 0 or ZCACHE_HEADER.size + index_size + offsets[-1] != filesize:
+        return None
+    return size, block_size, offsets
+
+def cache_file_size(path):
+    """ Return the size of the subtitle data cached in path, without
+        decompressing it, or None if it is a corrupt compressed sub. """
+    if not path.endswith(ZCACHE_SUFFIX):
+        return os.path.getsize(path)
+    f = open(path, 'rb')
+    try:
+        header = _read_cache_header(f)
+    finally:
+        f.close()
+    if header is None:
+        logging.warning('Ignoring corrupt compressed sub %s', path)
+        return None
+    return header[0]
+
+def open_cache_file(fullpath):
+    """ Return a CacheFile for the sub cached for fullpath, or None if it is
+        not cached or is corrupt. """
+    path = cache_file_path(fullpath)
+    if path is None:
+        return None
+    try:
+        return CacheFile(path)
+    except ValueError, e:
+        logging.warning('Ignoring %s', e)
+        return None
+
+
+class CacheFile(object):
+    """ Read-only access to a cached subtitle, which is stored either as
+        plain text or, if path ends with ZCACHE_SUFFIX, in the compressed
+        cache format. Raises ValueError for a corrupt compressed sub. """
+    mode = 'rb'
+    
+    def __init__(self, path):
+        self.file = open(path, 'rb')
+        self.compressed = False
+        self._block = (None, '')
+        
+        if not path.endswith(ZCACHE_SUFFIX):
+            self.size = os.fstat(self.file.fileno()).st_size
+            return
+        
+        header = _read_cache_header(self.file)
+        if header is None:
+            self.file.close()
+            raise ValueError('corrupt compressed sub %s' % path)
+        self.size, self.block_size, self.offsets = header
+        self.data_start = self.file.tell()
+        self.compressed = True
+    
+    def fileno(self):
+        return self.file.fileno()
+    
+    def close(self):
+        self.file.close()
+    
+    def _get_block(self, bnum):
+        # Keep the last decompressed block around, since reads are usually
+        # sequential and smaller than a block.
+        if self._block[0] != bnum:
+            start, end = self.offsets[bnum], self.offsets[bnum+1]
+            self.file.seek(self.data_start + start)
+            self._block = (bnum, zlib.decompress(self.file.read(end - start)))
+        return self._block[1]
+    
+    def read(self, size, offset=0):
+        if not self.compressed:
+            self.file.seek(offset)
+            return self.file.read(size)
+        
+        end = min(offset + size, self.size)
+        chunks = []
+        while offset < end:
+            bnum, boffset = divmod(offset, self.block_size)
+            block = self._get_block(bnum)[boffset:boffset + end - offset]
+            if not block:
+                break
+            chunks.append(block)
+            offset += len(block)
+        return ''.join(chunks)
+
+
+
+class CacheLease(object):
+    """ A lock file claiming the extraction of a cached sub, so that daemons
+        sharing a cache directory only extract each track once. Lock files
+        are used rather than fcntl locks, which are unreliable on network
+        filesystems. The holder keeps the lease alive by touching the lock
+        file, and a lease that has not been touched for LEASE_SECS is
+        considered abandoned and may be broken by another daemon. """
+    LEASE_SECS = 300.
+    POLL_SECS = 1.
+    
+    def __init__(self, path):
+        self.path = path + '.lock'
+        self.owner = unique_name('lease', random.randint(0, 2<<32))
+        self.logger = logging.getLogger('lease')
+        self._refresher = None
+        self._released = threading.Event()
+    
+    def acquire(self):
+        """ Try to take the lease, returning whether it was taken. """
+        try:
+            fd = os.open(self.path, os.O_WRONLY|os.O_CREAT|os.O_EXCL, 0644)
+        except OSError, e:
+            if e.errno != errno.EEXIST:
+                raise
+            if self.is_stale():
+                self._break_stale()
+            return False
+        
+        os.write(fd, self.owner)
+        os.close(fd)
+        self.logger.debug('acquired %s', self.path)
+        
+        self._released.clear()
+        self._refresher = threading.Thread(target=self._refresh)
+        self._refresher.setDaemon(True)
+        self._refresher.start()
+        return True
+    
+    def release(self):
+        self._released.set()
+        self._refresher.join()
+        self._refresher = None
+        # If our lease was broken as stale, the lock file may now belong to
+        # another daemon, so leave it alone.
+        if not self.is_owned():
+            self.logger.warning('lost lease %s before release', self.path)
+            return
+        try:
+            os.unlink(self.path)
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                raise
+        self.logger.debug('released %s', self.path)
+    
+    def is_owned(self):
+        """ Return whether the lock file is still the one we created. """
+        try:
+            return open(self.path).read() == self.owner
+        except IOError, e:
+            if e.errno != errno.ENOENT:
+                raise
+            return False
+    
+    def wait(self):
+        """ Wait for whoever holds the lease to release it or abandon it. """
+        while os.path.exists(self.path) and not self.is_stale():
+            time.sleep(self.POLL_SECS)
+    
+    def is_stale(self):
+        try:
+            return time.time() - os.stat(self.path).st_mtime > self.LEASE_SECS
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                raise
+            return False
+    
+    def _refresh(self):
+        while not self._released.wait(self.LEASE_SECS / 4):
+            try:
+                if not self.is_owned():
+                    self.logger.warning('lost lease %s', self.path)
+                    return
+                os.utime(self.path, None)
+            except OSError:
+                self.logger.exception('Failed to refresh %s', self.path)
+    
+    def _break_stale(self):
+        # Renaming is atomic, so only one daemon can take away a given lock
+        # file. If the one taken turns out to be live, another daemon broke
+        # the stale lease first and has since acquired it, so put it back.
+        stalepath = unique_name(self.path, 'stale')
+        try:
+            os.rename(self.path, stalepath)
+        except OSError:
+            return
+        try:
+            if time.time() - os.stat(stalepath).st_mtime <= self.LEASE_SECS:
+                try:
+                    os.link(stalepath, self.path)
+                except OSError:
+                    pass
+            else:
+                self.logger.warning('broke stale lease %s', self.path)
+        finally:
+            os.unlink(stalepath)
+
+
+class Extraction(object):
+    """ A sub being extracted into a partial file in TEMP_DIR, which can be
+        read from while it is still being written. Extractions in
+        progress are registered by cache path, so that each sub is only
+        extracted once by this daemon. """
+    POLL_SECS = 0.1
+    in_progress = {}
+    lock = threading.Lock()
+    
+    def __init__(self, fullpath):
+        self.fullpath = fullpath
+        base, ext = os.path.splitext(os.path.basename(fullpath))
+        self.partpath = os.path.join(TEMP_DIR, unique_name(base) + ext)
+        self.done = threading.Event()
+    
+    @classmethod
+    def begin(cls, fullpath):
+        """ Return the extraction of the sub at fullpath and whether it was
+            started by this call, rather than already in progress. """
+        key = os.path.normpath(fullpath)
+        with cls.lock:
+            extraction = cls.in_progress.get(key)
+            if extraction:
+                return extraction, False
+            extraction = cls.in_progress[key] = cls(fullpath)
+            return extraction, True
+    
+    @classmethod
+    def get(cls, fullpath):
+        """ Return the extraction of the sub at fullpath, if in progress. """
+        with cls.lock:
+            return cls.in_progress.get(os.path.normpath(fullpath))
+    
+    def finish(self):
+        # The sub has been published to the cache (or failed), so readers
+        # switch over from the partial file.
+        with self.lock:
+            del self.in_progress[os.path.normpath(self.fullpath)]
+        self.done.set()
+        if os.path.exists(self.partpath):
+            os.unlink(self.partpath)
+    
+    def size(self):
+        """ Return the number of bytes extracted so far. """
+        try:
+            return os.path.getsize(self.partpath)
+        except OSError:
+            return 0
+    
+    def wait_for(self, size):
+        """ Wait until size bytes have been extracted to the partial file,
+            returning False if the extraction finished first. """
+        while self.size() < size:
+            if self.done.wait(self.POLL_SECS):
+                return False
+        return True
+
+
+class ProgressiveFile(object):
+    """ Read-only access to a sub while it is being extracted. Reads are
+        served from the partial file, returning what has been extracted of
+        the requested range (short reads are fine with direct_io) and only
+        blocking when none of it has, and from the cache once the extraction
+        finishes. """
+    mode = 'rb'
+    
+    def __init__(self, extraction):
+        self.extraction = extraction
+        self.cache = None
+    
+    def close(self):
+        if self.cache:
+            self.cache.close()
+    
+    def read(self, size, offset=0):
+        while self.extraction.wait_for(offset + 1):
+            try:
+                f = open(self.extraction.partpath, 'rb')
+                try:
+                    f.seek(offset)
+                    data = f.read(size)
+                finally:
+                    f.close()
+            except IOError:
+                # The extraction finished in the meantime
+                break
+            if data:
+                return data
+        
+        self.extraction.done.wait()
+        if self.cache is None:
+            self.cache = open_cache_file(self.extraction.fullpath)
+            if self.cache is None:
+                return ''
+        return self.cache.read(size, offset)
+
+
+def start_extraction(mkvpath, fullpath, lang, logger=logging):
+    """ Make sure the subs of mkvpath are being extracted, and return the
+        Extraction of the one cached at fullpath, or None if it has already
+        been extracted (or could not be). """
+    extraction = Extraction.get(fullpath)
+    if extraction or cache_is_fresh(mkvpath, fullpath):
+        return extraction
+    
+    done = EXTRACTION_POOL.submit(mkvpath, lang, logger)
+    
+    # Wait for the extraction to get going, which may take a while if the
+    # pool is busy or another daemon sharing the cache holds the lease.
+    while not done.isSet():
+        extraction = Extraction.get(fullpath)
+        if extraction:
+            return extraction
+        done.wait(Extraction.POLL_SECS)
+    return Extraction.get(fullpath)
+
+
+class ExtractionPool(object):
+    """ Runs on-demand extractions in a bounded number of threads, so that a
+        scan stating many uncached subs does not run an mkvextract for each
+        of them at once. """
+    
+    def __init__(self, num_threads=2):
+        self.num_threads = num_threads
+        self.queue = Queue.Queue()
+        self.tasks = {}     # mkvpath -> Event set once extracted
+        self.lock = threading.Lock()
+        self.idle = threading.Condition(self.lock)
+        self.threads = []
+    
+    def submit(self, mkvpath, lang, logger=logging):
+        """ Queue the extraction of the subs of mkvpath, unless already
+            queued, and return an Event which is set once it is done. """
+        with self.lock:
+            done = self.tasks.get(mkvpath)
+            if done:
+                return done
+            done = self.tasks[mkvpath] = threading.Event()
+            
+            while len(self.threads) < self.num_threads:
+                t = threading.Thread(target=self._work,
+                                     name='ondemand-%d' % len(self.threads))
+                t.setDaemon(True)
+                t.start()
+                self.threads.append(t)
+        
+        self.queue.put((mkvpath, lang, logger, done))
+        return done
+    
+    def wait_idle(self):
+        with self.idle:
+            while self.tasks:
+                self.idle.wait()
+    
+    def _work(self):
+        while True:
+            mkvpath, lang, logger, done = self.queue.get()
+            try:
+                SubtitleExtractorThread.extract_and_cache_subs(mkvpath, lang, logger)
+            except Exception, e:
+                logger.exception("Exception during extraction of subtitles from %s", mkvpath)
+            
+            with self.lock:
+                del self.tasks[mkvpath]
+                if not self.tasks:
+                    self.idle.notifyAll()
+            done.set()
+
+# Runs extractions for subs which are being accessed but not yet cached
+EXTRACTION_POOL = ExtractionPool()
+
+
+class Track(object):
+    """ Compact record of a track of a video. Tracks are immutable and there
+        are few distinct ones across a library, so they are shared between
+        videos: use Track.get rather than creating them. """
+    __slots__ = ('num', 'type', 'codec', 'lang')
+    _shared = {}
+    
+    def __init__(self, num, type, codec, lang):
+        self.num = num
+        self.type = intern(type)
+        self.codec = intern(codec)
+        self.lang = intern(lang)
+    
+    @classmethod
+    def get(cls, num, type, codec, lang):
+        key = (num, type, codec, lang)
+        track = cls._shared.get(key)
+        if track is None:
+            track = cls._shared.setdefault(key, cls(*key))
+        return track
+    
+    def __repr__(self):
+        return '<Track %s %s %s %s>' % (self.num, self.type, self.codec, self.lang)
+
+
+class TrackIndex(object):
+    """ In-memory index of the tracks of videos by path, so that tracks can
+        be looked up by (video, type, language, codec) without running
+        mkvinfo. A video is reindexed when its mtime changes, and dropped
+        once it is found to no longer exist, either when looked up or by
+        the background scan. At most MAX_VIDEOS are kept, so that without
+        the scan (use_cache_only) the index cannot grow forever. """
+    MAX_VIDEOS = 100000
+    
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.videos = {}    # path -> (mtime, tracks)
+    
+    def tracks(self, mkv):
+        """ Return the tracks of MkvFile mkv, indexing them if needed. """
+        path = mkv.path
+        try:
+            mtime = os.stat(path).st_mtime
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                raise
+            with self.lock:
+                self.videos.pop(path, None)
+            return ()
+        
+        entry = self.videos.get(path)
+        if entry and entry[0] == mtime:
+            return entry[1]
+        
+        tracks = tuple([Track.get(i+1, trackinfo['type'],
+                                  trackinfo.get('codec ID', ''),
+                                  trackinfo.get('language', DEFAULT_LANG))
+                            for i, trackinfo in enumerate(mkv.info())])
+        with self.lock:
+            if len(self.videos) >= self.MAX_VIDEOS and path not in self.videos:
+                # Any will do, as a dropped video is just indexed again
+                self.videos.popitem()
+            self.videos[path] = (mtime, tracks)
+        return tracks
+    
+    def prune(self, root, seen):
+        """ Drop the videos under root which are not in seen, the paths of
+            the videos found by a scan of root. """
+        prefix = os.path.join(root, '')
+        with self.lock:
+            for path in [p for p in self.videos
+                            if p.startswith(prefix) and p not in seen]:
+                del self.videos[path]
+    
+    def find(self, mkv, type, lang, codec):
+        """ Return the first track of mkv matching type, lang and codec, or
+            None. """
+        for track in self.tracks(mkv):
+            if track.type == type and track.lang == lang and track.codec == codec:
+                return track
+        return None
+    
+    def find_all(self, mkv, type, lang):
+        """ Return the tracks of mkv matching type and lang. """
+        return [track for track in self.tracks(mkv)
+                    if track.type == type and track.lang == lang]
+
+# Shared by all MkvFiles, since a new MkvFile is made for each operation
+TRACK_INDEX = TrackIndex()
+
 
 class MkvFile(object):
     comma_split = re.compile(r"\s*,\s*(?![^\(]+?\))")
@@ -105,6 +709,7 @@ class MkvFile(object):
         self.path = path
         self.logger = logging.getLogger('mkvfile')
     
+    @PROFILER.profiled('mkv.info')
     def info(self, ignore_errors=True):
         mkv_path = self.path
         cmd = ('mkvinfo', '-s')
@@ -155,21 +760,28 @@ class MkvFile(object):
         
         return info
     
+    @PROFILER.profiled('mkv.get_subtitle_track_num')
     def get_subtitle_track_num(self, stype, lang='eng'):
-        info = self.info()
-        for i, trackinfo in enumerate(info):
-            if trackinfo['type'] == 'subtitles' \
-                    and trackinfo['codec ID'] == self.SUBEXT_MIME_MAP.get(stype, None) \
-                    and trackinfo.get('language', DEFAULT_LANG) == lang:
-                return i+1
-        return 0
+        track = TRACK_INDEX.find(self, 'subtitles', lang,
+                                 self.SUBEXT_MIME_MAP.get(stype, None))
+        return track and track.num or 0
+    
+    def subtitle_tracks(self, lang='eng'):
+        """ Return the subtitle tracks in language lang. """
+        return TRACK_INDEX.find_all(self, 'subtitles', lang)
     
     def has_subtitle(self, stype, lang='eng'):
         return self._get_subtitle_track_num > 0 and True or False
     
     #~ def get_subtitle_names(self, )
     
-    def extract(self, tracknum):
+    @PROFILER.profiled('mkv.extract')
+    def extract(self, tracknum, tmppath=None):
+        """ Extract track number tracknum and return its data. The track is
+            written to tmppath while being extracted, which defaults to a
+            unique path in TEMP_DIR and is then removed. A given tmppath is
+            left for the caller to remove, so that it can be read until the
+            sub is published. """
         mkv_path = self.path
         cmd = ('mkvextract', 'tracks', '-r', '/dev/null')
         stdout = None
@@ -180,14 +792,27 @@ class MkvFile(object):
         
         mkvdir, mkvname = os.path.split(mkv_path)
         mkvbasename, mkvext = os.path.splitext(mkvname)
-        subext = self.SUBMIME_EXT_MAP[self.info()[tracknum-1]['codec ID']]
+        codec = TRACK_INDEX.tracks(self)[tracknum-1].codec
+        subext = self.SUBMIME_EXT_MAP[codec]
         
-        #~ tmpname = '%s.%s.%s.%s' % (os.getpid(), time.time(), random.randint(0, 2<<32), subext)
-        tmpname = '%s.%s.%s' % (os.getpid(), mkvbasename, subext)
-        tmppath = os.path.join(TEMP_DIR, tmpname)
+        remove_tmppath = tmppath is None
+        if tmppath is None:
+            #~ tmpname = '%s.%s.%s.%s' % (os.getpid(), time.time(), random.randint(0, 2<<32), subext)
+            tmpname = '%s.%s' % (unique_name(mkvbasename), subext)
+            tmppath = os.path.join(TEMP_DIR, tmpname)
         cmd += (mkv_path, '%s:%s'%(tracknum, tmppath))
         #~ self.logger.debug('cmd: %s', cmd)
         
+        if not os.path.exists(tmppath) and codec in SubtitleDemuxer.WRITERS:
+            # Text subs are demuxed natively, which writes them out as they
+            # are read, unlike mkvextract.
+            try:
+                self.demux(tracknum, tmppath)
+            except ValueError, e:
+                self.logger.warning('Demuxing track %s of %s failed, '
+                                    'using mkvextract: %s', tracknum, mkv_path, e)
+                os.unlink(tmppath)
+        
         if not os.path.exists(tmppath):
             p = None
             if sys.version_info[:2] < (2, 5):
@@ -206,10 +831,24 @@ class MkvFile(object):
             self._cleanup_child_process(p)
         
         data = open(tmppath).read()
-        os.unlink(tmppath)
+        if remove_tmppath:
+            os.unlink(tmppath)
         
         return data
     
+    def demux(self, tracknum, path):
+        """ Write text subtitle track number tracknum to path, a cluster at
+            a time. """
+        mkv = open(self.path, 'rb')
+        try:
+            out = open(path, 'wb')
+            try:
+                SubtitleDemuxer(mkv, tracknum).demux(out)
+            finally:
+                out.close()
+        finally:
+            mkv.close()
+    
     def _cleanup_child_process(self, p):
         if p:
             # SIGKILL
@@ -222,16 +861,33 @@ class MkvFile(object):
 # temporary directory.
 class SubtitleExtractorThread(threading.Thread):
     SLEEP_BETWEEN_SCANS_SECS = 60.
+    # Number of prefetched videos remembered, so they are not queued again
+    MAX_PREFETCHED = 10000
+    # Number of opened subs remembered, for counting cache hits
+    MAX_REQUESTED = 10000
+    # Don't prefetch after a sub again if opened within this many seconds
+    PREFETCH_AGAIN_SECS = 60.
     
-    def __init__(self, root, lang='eng'):
+    def __init__(self, root, lang='eng', prefetch_depth=0):
         self.logger = logging.getLogger('extractor')
         self.logger.info('init thread')
-        threading.Thread.__init__(self)
+        threading.Thread.__init__(self, name='extractor')
         self.root = root
         self.lang = lang
         self.immediate_extraction = collections.deque()
         #~ self.condition = condition
         
+        # Videos likely to be wanted soon are queued for prefetching, which
+        # is done after immediate extractions but before the scan continues.
+        self.prefetch_depth = prefetch_depth
+        self.prefetch_queue = collections.deque()
+        self.prefetch_queued = set()
+        self.prefetched = collections.OrderedDict()
+        self.requested = collections.OrderedDict()  # sub -> time last opened
+        self.prefetch_lock = threading.Lock()
+        self.request_hits = self.requests = 0
+        self.wakeup = threading.Event()
+        
     def run(self):
         try:
             self._run()
@@ -243,6 +899,7 @@ class SubtitleExtractorThread(threading.Thread):
         self.logger.info('running extractor thread: %s', self.root)
         while True:
             # continually scan root
+            seen = set()
             for path, dirs, files in os.walk(self.root):
                 for file in files:
                     # hook to make sure requests from the filesystem get
@@ -255,61 +912,208 @@ class SubtitleExtractorThread(threading.Thread):
                     
                     self.logger.debug("Thinking about extracting: %s", fullpath)
                     if ext in VIDEO_EXTS:
+                        seen.add(fullpath)
                         self.extract_subs(fullpath)
             
-            time.sleep(self.SLEEP_BETWEEN_SCANS_SECS)
+            # Forget the tracks of videos which were deleted or renamed
+            TRACK_INDEX.prune(self.root, seen)
+            
+            # Sleep until the next scan, unless there is extraction to do
+            # before then.
+            while self.wakeup.wait(self.SLEEP_BETWEEN_SCANS_SECS):
+                self.wakeup.clear()
+                self.do_immediate_extraction()
     
     def do_immediate_extraction(self):
-        while self.immediate_extraction:
+        while self.immediate_extraction or self.prefetch_queue:
             try:
                 mkvpath = self.immediate_extraction.popleft()
                 self.extract_subs(mkvpath)
+                continue
             except IndexError:
-                return
+                pass
+            
+            # Prefetch one at a time, so immediate extractions queued in the
+            # meantime go first, and not while subs which are being accessed
+            # are extracted on demand.
+            EXTRACTION_POOL.wait_idle()
+            with self.prefetch_lock:
+                if not self.prefetch_queue:
+                    return
+                mkvpath = self.prefetch_queue.popleft()
+                self.prefetch_queued.discard(mkvpath)
+            
+            self.logger.debug('Prefetching %s', mkvpath)
+            if self.extract_subs(mkvpath):
+                with self.prefetch_lock:
+                    self.prefetched[mkvpath] = True
+                    if len(self.prefetched) > self.MAX_PREFETCHED:
+                        self.prefetched.popitem(last=False)
+    
+    def prefetch(self, mkvpaths, first=False):
+        """ Queue videos for extraction ahead of the background scan. If
+            first is set they go ahead of those already queued, in order. """
+        with self.prefetch_lock:
+            if first:
+                for mkvpath in reversed(mkvpaths):
+                    if mkvpath in self.prefetched:
+                        continue
+                    if mkvpath in self.prefetch_queued:
+                        self.prefetch_queue.remove(mkvpath)
+                    self.prefetch_queue.appendleft(mkvpath)
+                    self.prefetch_queued.add(mkvpath)
+            else:
+                for mkvpath in mkvpaths:
+                    if mkvpath not in self.prefetch_queued \
+                            and mkvpath not in self.prefetched:
+                        self.prefetch_queue.append(mkvpath)
+                        self.prefetch_queued.add(mkvpath)
+        self.wakeup.set()
+    
+    def prefetch_dir(self, dirpath, names):
+        """ Prefetch the videos among names in dirpath, which has just been
+            listed and so will probably be scanned next. """
+        if self.prefetch_depth <= 0:
+            return
+        videos = [n for n in names
+                    if os.path.splitext(n)[1][1:].lower() in VIDEO_EXTS]
+        videos.sort(key=natural_sort_key)
+        self.prefetch([os.path.join(dirpath, n) for n in videos])
+    
+    def prefetch_siblings(self, mkvpath, names=None):
+        """ Prefetch the videos following mkvpath in its directory, which are
+            likely the next episodes. names is the directory listing, if
+            already known. """
+        if self.prefetch_depth <= 0:
+            return
+        dirpath, name = os.path.split(mkvpath)
+        if names is None:
+            names = os.listdir(dirpath)
+        videos = [n for n in names
+                    if os.path.splitext(n)[1][1:].lower() in VIDEO_EXTS]
+        videos.sort(key=natural_sort_key)
+        try:
+            i = videos.index(name)
+        except ValueError:
+            return
+        # These are more likely to be wanted next than the rest of a listed
+        # directory, so move them to the front.
+        self.prefetch([os.path.join(dirpath, n)
+                        for n in videos[i+1:i+1+self.prefetch_depth]],
+                      first=True)
+    
+    def recently_requested(self, subpath):
+        """ Return whether subpath was opened within PREFETCH_AGAIN_SECS, so
+            the subs after it have already been prefetched. """
+        with self.prefetch_lock:
+            when = self.requested.get(subpath)
+        return when is not None and time.time() - when < self.PREFETCH_AGAIN_SECS
+    
+    def note_request(self, subpath, mkvpath, fullpath):
+        """ Note that subpath, from mkvpath and cached at fullpath, was
+            opened. The first time a sub is opened counts as a hit if it was
+            already in the cache, whether prefetched or scanned. """
+        with self.prefetch_lock:
+            first = self.requested.pop(subpath, None) is None
+            self.requested[subpath] = time.time()
+            if len(self.requested) > self.MAX_REQUESTED:
+                self.requested.popitem(last=False)
+        if not first:
+            return
+        
+        hit = cache_is_fresh(mkvpath, fullpath)
+        with self.prefetch_lock:
+            self.requests += 1
+            self.request_hits += hit
+        self.logger.debug('%s %s cache', subpath, hit and 'hit' or 'missed')
+    
+    def counters(self):
+        """ Return the cache hit counters, for the profile dumps. """
+        with self.prefetch_lock:
+            return {'requests': self.requests, 'hits': self.request_hits}
     
     def extract_subs(self, mkvpath):
-        """ """
+        """ Extract and cache the subs of mkvpath, returning whether this
+            succeeded. """
         try:
             self.extract_and_cache_subs(mkvpath, self.lang, self.logger)
+            return True
         except Exception, e:
             logging.exception("Exception during extraction of subtitles from %s"%mkvpath)
+            return False
     
     @staticmethod
+    @PROFILER.profiled('extractor.extract_and_cache_subs')
     def extract_and_cache_subs(mkvpath, lang, logger=logging):
         cached_subs = []
         basepath, ext = os.path.splitext(mkvpath)
         mkv = MkvFile(mkvpath)
-        for tnum, trackinfo in enumerate(mkv.info()):
-            if trackinfo['type'] == 'subtitles' \
-                    and trackinfo.get('language', DEFAULT_LANG) == lang:
-                logger.debug('mkv track info: %r', trackinfo)
-                subext = mkv.SUBMIME_EXT_MAP.get(trackinfo['codec ID'], None)
-                if subext in SUPPORTED_SUBS:
-                    fullpath = os.path.join(CACHE_DIR, '.'.join([basepath.lstrip('/'), subext]))
-                    
-                    if os.path.isfile(fullpath) \
-                        and os.lstat(mkvpath).st_mtime == os.lstat(fullpath).st_mtime:
-                        # mkv has not changed and subfile exists
-                        return
-                    
-                    # Make sure the path is created
-                    fullpath_dirname = os.path.dirname(fullpath)
-                    os.makedirs(fullpath_dirname)
-                    
-                    logger.debug('Writing %s to cache', fullpath)
-                    subdata = mkv.extract(tnum+1)
-                    open(fullpath, 'w').write(subdata)
-                    
-                    # Set access and modification time on sub file to same
-                    # as on mkv, so if mkv changes we know to update the
-                    # sub.
-                    mkvstat = os.lstat(mkvpath)
-                    logger.debug('Setting mtime: %s', mkvstat.st_mtime)
-                    os.utime(fullpath, (mkvstat.st_atime, mkvstat.st_mtime))
-                    
+        for track in mkv.subtitle_tracks(lang):
+            logger.debug('mkv track info: %r', track)
+            subext = mkv.SUBMIME_EXT_MAP.get(track.codec, None)
+            if subext in SUPPORTED_SUBS:
+                fullpath = os.path.join(CACHE_DIR, '.'.join([basepath.lstrip('/'), subext]))
+                
+                if cache_is_fresh(mkvpath, fullpath):
+                    # mkv has not changed and subfile exists
                     cached_subs.append(fullpath)
+                    continue
+                
+                # Make sure the path is created
+                fullpath_dirname = os.path.dirname(fullpath)
+                os.makedirs(fullpath_dirname)
+                
+                extraction, started = Extraction.begin(fullpath)
+                if not started:
+                    # Another thread is already extracting it
+                    logger.debug('Waiting on extraction of %s', fullpath)
+                    extraction.done.wait()
+                    cached_subs.append(fullpath)
+                    continue
+                
+                try:
+                    SubtitleExtractorThread.cache_track(
+                        mkv, track, fullpath, extraction.partpath, logger)
+                finally:
+                    extraction.finish()
+                
+                cached_subs.append(fullpath)
         return cached_subs
     
+    @staticmethod
+    def cache_track(mkv, track, fullpath, tmppath, logger=logging):
+        """ Extract track of mkv via tmppath and publish it to the cache at
+            fullpath, unless another daemon sharing the cache does first. """
+        mkvpath = mkv.path
+        lease = None
+        if CACHE_SHARED:
+            # Claim the track so that other daemons sharing the cache wait
+            # for us instead of extracting it too.
+            lease = CacheLease(fullpath)
+            while not lease.acquire():
+                logger.debug('Waiting on lease for %s', fullpath)
+                lease.wait()
+                if cache_is_fresh(mkvpath, fullpath):
+                    # Another daemon extracted it
+                    return
+        
+        try:
+            if lease and cache_is_fresh(mkvpath, fullpath):
+                # Published just before we took the lease
+                return
+            
+            # Set access and modification time on sub file to same as on
+            # mkv, so if mkv changes we know to update the sub.
+            mkvstat = os.lstat(mkvpath)
+            logger.debug('Writing %s to cache with mtime %s',
+                         fullpath, mkvstat.st_mtime)
+            subdata = mkv.extract(track.num, tmppath)
+            write_cache_file(fullpath, subdata,
+                times=(mkvstat.st_atime, mkvstat.st_mtime))
+        finally:
+            if lease:
+                lease.release()
+    
     def cleanup(self):
         """ Remove cached subtitles with no video file """
         raise NotImplementedError
@@ -329,62 +1133,88 @@ class SubFile(FuseFile):
         super(SubFile, self).__init__(*args, **kwargs)
         self.abspath = os.path.join(self.root.rstrip('/'), self.path.lstrip('/'))
         
+        # Cached subs may be compressed, so read them through a CacheFile
+        # rather than the plain file opened by FuseFile.
+        if self.file:
+            self.file.close()
+        self.file = open_cache_file(self.fullpath)
+        if self.file:
+            self.fd = self.file.fileno()
+        
         # This didn't seem to invalidate the cache, or at least I'm still
         # getting read errors, which disappear when using direct_io = True
         #~ self.fuse.Invalidate(self.path)
         #~ self.fuse.Invalidate(self.abspath)
         
+        # The video is only needed to extract the sub or to prefetch the
+        # ones after it, which was done already if it was opened recently.
+        extractor = self.fuse.t
+        prefetching = extractor and extractor.prefetch_depth > 0 \
+                        and not extractor.recently_requested(self.abspath)
+        self.mkv_path = None
+        if not self.file or prefetching:
+            names = os.listdir(os.path.dirname(self.abspath))
+            self.mkv_path = self.find_video(names)
+        if prefetching and self.mkv_path:
+            extractor.note_request(self.abspath, self.mkv_path, self.fullpath)
+            extractor.prefetch_siblings(self.mkv_path, names)
+        
         self.extract_subfiles()
     
+    def find_video(self, names):
+        """ Return the path of the video file this sub is from, or None.
+            names is the listing of the sub's directory. """
+        base, ext = os.path.splitext(self.abspath)
+        ext = ext[1:]
+        
+        if ext.lower() in SUBTITLE_EXTS:
+            basedir, basename = os.path.split(base)
+            for f in names:
+                fbase, fext = os.path.splitext(f)
+                if fbase == basename and fext[1:].lower() in VIDEO_EXTS:
+                    return os.path.join(basedir, f)
+        return None
+    
     def extract_subfiles(self):
         if not self.file:
-            base, ext = os.path.splitext(self.abspath)
-            ext = ext[1:]
-            
-            if ext.lower() in SUBTITLE_EXTS:
-                # Trying to access a "virtual" subtitle file
-                basedir, basename = os.path.split(base)
-                
-                self.logger.debug('>> %s %s', basename, os.listdir(basedir))
-                # Get potential video file matches
-                potential_match = [f for f in os.listdir(basedir)
-                                    if f.startswith(basename) \
-                                        and os.path.splitext(f)[1][1:].lower() in VIDEO_EXTS]
-                assert len(potential_match) < 2, 'More than one potential match: %s'%potential_match
-                
-                self.logger.debug('potential_match: %s', potential_match)
-                if len(potential_match) == 0:
-                    return -errno.ENOENT
-                
-                mkv_path = os.path.join(basedir, potential_match[0])
-                
-                subpaths = SubtitleExtractorThread.extract_and_cache_subs(
-                    mkv_path, self.lang, logger
-                )
-                
-                if os.path.exists(self.fullpath):
-                    self.file = open(self.fullpath, 'rb')
-                    self.fd = self.file.fileno()
+            if self.mkv_path:
+                # Serve the sub while it is being extracted, rather than
+                # waiting for the whole video to be read.
+                extraction = start_extraction(self.mkv_path, self.fullpath,
+                                              self.fuse.lang, self.logger)
+                if extraction:
+                    self.file = ProgressiveFile(extraction)
+                    self.fd = None
+                else:
+                    self.file = open_cache_file(self.fullpath)
+                    if self.file:
+                        self.fd = self.file.fileno()
+    
+    def flush(self):
+        # Subs are read-only, so there is nothing to flush
+        return 0
     
     #~ def write(self, buf, offset):
         #~ path = self.path
         #~ self.logger.info("write: %s %s %s", path, buf, offset)
         #~ return -errno.EROFS
     
+    @TRACER.traced('read', file_op=True)
+    @PROFILER.profiled('fuse.read')
     def read(self, size, offset):
         path = self.path
         abspath = self.abspath
         self.logger.info("read: %s %s %s", path, size, offset)
         
         try:
-            self.file.seek(offset)
-            data = self.file.read(size)
+            data = self.file.read(size, offset)
             #~ data = self.file.read(size-(size%(4*4*1024))-1)
             self.logger.debug("read: return %s %r %r", len(data), data[:20], data[-20:])
             return data
         except Exception, e:
             self.logger.exception('Exception while reading')
     
+    @PROFILER.profiled('fuse.fgetattr')
     def fgetattr(self):
         self.logger.info("fgetattr %s %s %s", self.path, self.abspath, self.fullpath)
         try:
@@ -403,10 +1233,21 @@ class SubFile(FuseFile):
 #~ SubFile = wrapped_file_class
 
 
+class VideoFile(LoopbackFile):
+    """ A file under root, such as a video, passed through as is. """
+    
+    @TRACER.traced('read', file_op=True)
+    @PROFILER.profiled('fuse.read_video')
+    def read(self, length, offset=0):
+        return super(VideoFile, self).read(length, offset)
+
+
 class SubtitleFileProxy(FileProxy):
     root = None
     fuse = None
     
+    @TRACER.traced('open')
+    @PROFILER.profiled('fuse.open')
     def multiplex(self, path, flags, *mode, **kwargs):
         logging.debug('proxy.multiplex: %s %s', path, flags)
         base, ext = os.path.splitext(path)
@@ -417,8 +1258,9 @@ class SubtitleFileProxy(FileProxy):
                             prefix=os.path.join(CACHE_DIR, self.root.lstrip('/')))
             else:
                 #~ file = open(path, mode)
-                file = LoopbackFile(path, flags, prefix=self.root)
-                logging.debug('read in open: %r', file.read(10))
+                file = VideoFile(path, flags, prefix=self.root)
+                # Not traced, since replaying the open reads it again
+                logging.debug('read in open: %r', LoopbackFile.read(file, 10))
                 #~ file = fuse.FuseFileInfo(direct_io=True)
         except Exception, e:
             logging.exception('Got exception in multiplex')
@@ -436,8 +1278,20 @@ class SubsFuse(fuse.Fuse):
         self.lang = 'eng'
         self.log = self.loglevel = self.cachedir = None
         self.use_cache_only = False
+        self.compress = False
+        self.shared_cache = False
+        self.trace = None
+        self.prefetch = 2
+        self.extract_threads = 2
+        self.t = None
     
     def main(self, *args, **kwargs):
+        self.setup()
+        super(SubsFuse, self).main(*args, **kwargs)
+    
+    def setup(self):
+        """ Prepare to serve ops once the options have been parsed. This is
+            separate from main so that ops can be driven without mounting. """
         # Setup the logging here, which should be as soon as possible
         # after parsing the command line options
         logging_opts = dict(stream = sys.stderr)
@@ -456,8 +1310,6 @@ class SubsFuse(fuse.Fuse):
         self.file_class = SubtitleFileProxy
         SubtitleFileProxy.fuse = self
         SubtitleFileProxy.root = self.root
-        
-        super(SubsFuse, self).main(*args, **kwargs)
     
     def fsinit(self):
         # Reset set globals depending on the value of cache dir
@@ -469,26 +1321,54 @@ class SubsFuse(fuse.Fuse):
             CACHEDB = os.path.join(CACHE_DIR, CACHEDB_NAME)
             TEMP_DIR = os.path.join(CACHE_DIR, TEMP_NAME)
         
+        global CACHE_COMPRESS
+        global CACHE_SHARED
+        CACHE_COMPRESS = self.compress
+        CACHE_SHARED = self.shared_cache
+        EXTRACTION_POOL.num_threads = int(self.extract_threads)
+        
+        if self.trace:
+            TRACER.start(self.trace)
+        
+        ctlname = PROFILE_CTL_NAME % (socket.gethostname(), os.getpid())
+        PROFILER.watch(os.path.join(CACHE_DIR, ctlname),
+                       os.path.join(CACHE_DIR, PROFILE_NAME))
+        
         # Don't start the extractor thread if told to only use cache
         if not self.use_cache_only:
-            self.t = t = SubtitleExtractorThread(self.root, self.lang)
+            self.t = t = SubtitleExtractorThread(self.root, self.lang,
+                                                 int(self.prefetch))
             t.setDaemon(True)
             t.start()
+            PROFILER.add_counters('cache', t.counters)
     
     def fsdestroy(self):
+        TRACER.stop()
         logging.shutdown()
     
+    @TRACER.traced('getattr')
+    @PROFILER.profiled('fuse.getattr')
     def getattr(self, path):
         #~ if self.icase:
             #~ path = path.lower()
         abspath = os.path.join(self.root, path.lstrip('/'))
         cachepath = os.path.join(CACHE_DIR, abspath.lstrip('/'))
         self.logger.info("getattr %s %s %s", path, abspath, cachepath)
+        zcachepath = cachepath + ZCACHE_SUFFIX
+        sub_stat = None
         if os.path.exists(abspath):
             sub_stat = os.lstat(abspath)
         elif os.path.exists(cachepath):
             sub_stat = os.lstat(cachepath)
-        else:
+        elif os.path.exists(zcachepath):
+            # Report the size of the subtitle data it holds, unless it is
+            # corrupt and so has to be extracted again.
+            size = cache_file_size(zcachepath)
+            if size is not None:
+                sub_stat = SubStat(os.lstat(zcachepath))
+                sub_stat.st_size = size
+        
+        if sub_stat is None:
             base, ext = os.path.splitext(abspath)
             ext = ext[1:]
             
@@ -517,16 +1397,31 @@ class SubsFuse(fuse.Fuse):
                     if tnum == 0:
                         # Track not found for this sub type and language
                         return -errno.ENOENT
-                    subdata = mkv.extract(tnum)
+                    
+                    sub_stat = SubStat(mkv_stat)
+                    extraction = start_extraction(mkv_path, cachepath,
+                                                  self.lang, self.logger)
+                    cached = cache_file_path(cachepath)
+                    if extraction and not extraction.done.isSet():
+                        # Rather than waiting for the whole video to be
+                        # read, report a provisional size. The real one is
+                        # seen once the kernel's cached attributes expire
+                        # (after attr_timeout, 1s by default).
+                        sub_stat.st_size = EXTRACTING_SIZE
+                    elif cached:
+                        sub_stat.st_size = cache_file_size(cached) or 0
+                    elif extraction:
+                        # The extraction failed
+                        sub_stat.st_size = 0
+                    else:
+                        # Not a sub format which gets cached
+                        sub_stat.st_size = len(mkv.extract(tnum))
                 except Exception, e:
                     #~ import traceback
                     #~ traceback.print_exc()
                     self.logger.exception("Logged exception while trying to extract subtitles from %s", mkv_path)
                     raise
                 
-                sub_stat = SubStat(mkv_stat)
-                sub_stat.st_size = len(subdata)
-                
             else:
                 # Either not a subtitle access or no such subtitle existed in
                 # the video file
@@ -535,25 +1430,30 @@ class SubsFuse(fuse.Fuse):
         self.logger.debug('sub_stat: %s', sub_stat)
         return sub_stat
     
+    @TRACER.traced('readdir')
+    @PROFILER.profiled('fuse.readdir')
     def readdir(self, path, offset):
         abspath = os.path.join(self.root.rstrip('/'), path.lstrip('/'))
         self.logger.info("readdir: %s %s", path, offset)
-        for e in os.listdir(abspath)[offset:]:
+        entries = os.listdir(abspath)
+        if self.t and offset == 0:
+            self.t.prefetch_dir(abspath, entries)
+        for e in entries[offset:]:
             yield fuse.Direntry(e)
             
             basename, ext = os.path.splitext(e)
             ext = ext[1:]
             if ext.lower() in VIDEO_EXTS:
                 mkv = MkvFile(os.path.join(abspath, e))
-                for trackinfo in mkv.info(ignore_errors=True):
-                    if trackinfo['type'] == 'subtitles' \
-                            and trackinfo.get('language', DEFAULT_LANG) == self.lang:
-                        self.logger.debug('mkv track info: %s', trackinfo)
-                        subext = mkv.SUBMIME_EXT_MAP[trackinfo['codec ID']]
-                        if subext in SUPPORTED_SUBS:
-                            yield fuse.Direntry('.'.join([basename, subext]))
-                            #~ yield fuse.Direntry('.'.join([basename, subext]), type=stat.S_IFREG)
+                for track in mkv.subtitle_tracks(self.lang):
+                    self.logger.debug('mkv track info: %s', track)
+                    subext = mkv.SUBMIME_EXT_MAP.get(track.codec, None)
+                    if subext in SUPPORTED_SUBS:
+                        yield fuse.Direntry('.'.join([basename, subext]))
+                        #~ yield fuse.Direntry('.'.join([basename, subext]), type=stat.S_IFREG)
 
+    @TRACER.traced('readlink')
+    @PROFILER.profiled('fuse.readlink')
     def readlink(self, path):
         abspath = os.path.join(self.root, path.lstrip('/'))
         return os.readlink(abspath)
@@ -591,6 +1491,17 @@ def main():
                              #~ help="set case insensitivity [default: %default]")
     server.parser.add_option(mountopt='use_cache_only', default=False, action='store_true',
                              help="only use cached subs, do not run extracting thread [default: %default]")
+    server.parser.add_option(mountopt='compress', default=False, action='store_true',
+                             help="store cached subs compressed [default: %default]")
+    server.parser.add_option(mountopt='shared_cache', default=False, action='store_true',
+                             help="coordinate extraction with other daemons using the same cache directory [default: %default]")
+    server.parser.add_option(mountopt='extract_threads', metavar='NUM', default=2,
+                             help="extract at most NUM uncached subs being accessed at once [default: %default]")
+    server.parser.add_option(mountopt='prefetch', metavar='NUM', default=2,
+                             help="prefetch subs for the NUM videos after an opened one, "
+                                  "and for directories when listed, 0 to disable [default: %default]")
+    server.parser.add_option(mountopt='trace', metavar='FILE', default=None,
+                             help="record FUSE ops to FILE for replay.py [default: %default]")
     server.parser.add_option(mountopt='log', metavar='FILE', default=None,
                              help="log to FILE [default: %default]")
     server.parser.add_option(mountopt='loglevel', metavar='LEVEL', default=None,
@@ -0,0 +1,131 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# Check reading and writing of cached subs, plain and compressed.
+# Run with: python test_cachefile.py
+# Copyright 2011 crass <crass@berlios.de>
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#   1. Redistributions of source code must retain the above copyright notice,
+#      this list of conditions and the following disclaimer.
+#   2. Redistributions in binary form must reproduce the above copyright notice,
+#      this list of conditions and the following disclaimer in the documentation
+#      and/or other materials provided with the distribution.
+#   3. The name of the author may not be used to endorse or promote products
+#      derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR ``AS IS'' AND ANY EXPRESS OR IMPLIED
+# WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO
+# EVENT SHALL THE AUTHOR BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS;
+# OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR
+# OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+# ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import subtitlefs
+
+BLOCK_SIZE = subtitlefs.ZCACHE_BLOCK_SIZE
+
+
+class CacheFileTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'video.srt')
+        # Several blocks, the last one partial, with a different byte at
+        # each offset in a block so misplaced reads show up.
+        self.data = ''.join([chr(i % 251) for i in xrange(2*BLOCK_SIZE + 1000)])
+    
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+    
+    def read_all(self, f, size=4096):
+        chunks = []
+        offset = 0
+        while True:
+            chunk = f.read(size, offset)
+            if not chunk:
+                return ''.join(chunks)
+            chunks.append(chunk)
+            offset += len(chunk)
+    
+    def test_roundtrip(self):
+        for compress in (False, True):
+            for data in ('', 'x', self.data):
+                subtitlefs.write_cache_file(self.path, data, compress)
+                f = subtitlefs.open_cache_file(self.path)
+                self.assertEqual(f.compressed, compress)
+                self.assertEqual(f.size, len(data))
+                self.assertEqual(self.read_all(f), data)
+                self.assertEqual(f.read(100, len(data)), '')
+                f.close()
+                self.assertEqual(subtitlefs.cache_file_size(
+                    subtitlefs.cache_file_path(self.path)), len(data))
+    
+    def test_read_across_blocks(self):
+        subtitlefs.write_cache_file(self.path, self.data, compress=True)
+        f = subtitlefs.open_cache_file(self.path)
+        for offset, size in ((BLOCK_SIZE - 10, 20), (BLOCK_SIZE - 1, 1),
+                             (BLOCK_SIZE, 1), (10, 2*BLOCK_SIZE),
+                             (2*BLOCK_SIZE + 900, 500), (0, 10*BLOCK_SIZE)):
+            self.assertEqual(f.read(size, offset),
+                             self.data[offset:offset+size])
+        f.close()
+    
+    def test_compress_option_changed(self):
+        subtitlefs.write_cache_file(self.path, 'plain', compress=False)
+        subtitlefs.write_cache_file(self.path, 'zipped', compress=True)
+        self.assertFalse(os.path.exists(self.path))
+        self.assertEqual(subtitlefs.cache_file_path(self.path),
+                         self.path + subtitlefs.ZCACHE_SUFFIX)
+        subtitlefs.write_cache_file(self.path, 'plain', compress=False)
+        self.assertEqual(subtitlefs.cache_file_path(self.path), self.path)
+        self.assertFalse(os.path.exists(self.path + subtitlefs.ZCACHE_SUFFIX))
+    
+    def test_plain_sub_starting_with_magic(self):
+        data = subtitlefs.ZCACHE_MAGIC + self.data
+        subtitlefs.write_cache_file(self.path, data, compress=False)
+        f = subtitlefs.open_cache_file(self.path)
+        self.assertFalse(f.compressed)
+        self.assertEqual(self.read_all(f), data)
+        f.close()
+    
+    def test_corrupt_compressed_sub(self):
+        mkvpath = os.path.join(self.dir, 'video.mkv')
+        open(mkvpath, 'w').close()
+        times = (os.stat(mkvpath).st_atime, os.stat(mkvpath).st_mtime)
+        subtitlefs.write_cache_file(self.path, self.data, True, times)
+        self.assertTrue(subtitlefs.cache_is_fresh(mkvpath, self.path))
+        
+        zpath = self.path + subtitlefs.ZCACHE_SUFFIX
+        f = open(zpath, 'rb')
+        self.assertEqual(subtitlefs._read_cache_header(f)[0], len(self.data))
+        f.close()
+        
+        # Truncate it, as a crash while writing without rename might
+        f = open(zpath, 'r+b')
+        f.truncate(os.path.getsize(zpath) - 1)
+        f.close()
+        os.utime(zpath, times)
+        f = open(zpath, 'rb')
+        self.assertEqual(subtitlefs._read_cache_header(f), None)
+        f.close()
+        self.assertEqual(subtitlefs.cache_file_size(zpath), None)
+        self.assertEqual(subtitlefs.open_cache_file(self.path), None)
+        self.assertFalse(subtitlefs.cache_is_fresh(mkvpath, self.path))
+        
+        open(zpath, 'wb').write('not compressed')
+        self.assertEqual(subtitlefs.open_cache_file(self.path), None)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,372 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# Check native demuxing of text subs and serving subs while they are being
+# extracted. Run with: python test_extraction.py
+# Copyright 2011 crass <crass@berlios.de>
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#   1. Redistributions of source code must retain the above copyright notice,
+#      this list of conditions and the following disclaimer.
+#   2. Redistributions in binary form must reproduce the above copyright notice,
+#      this list of conditions and the following disclaimer in the documentation
+#      and/or other materials provided with the distribution.
+#   3. The name of the author may not be used to endorse or promote products
+#      derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR ``AS IS'' AND ANY EXPRESS OR IMPLIED
+# WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO
+# EVENT SHALL THE AUTHOR BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS;
+# OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR
+# OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+# ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import os
+import shutil
+import struct
+import tempfile
+import threading
+import time
+import unittest
+import zlib
+
+import mkvdemux
+import subtitlefs
+
+TRACKS = [
+    {'type': 'video', 'codec ID': 'V_MPEG4/ISO/AVC'},
+    {'type': 'subtitles', 'codec ID': 'S_TEXT/UTF8', 'language': 'eng'},
+    {'type': 'subtitles', 'codec ID': 'S_TEXT/ASS', 'language': 'eng'},
+]
+ASS_HEADER = '[Script Info]\nScriptType: v4.00+\n\n[Events]\n' \
+             'Format: Layer, Start, End, Style, Name, MarginL, MarginR, ' \
+             'MarginV, Effect, Text\n'
+UNKNOWN_SIZE = '\x01\xff\xff\xff\xff\xff\xff\xff'
+
+
+def element(id, data, size=None):
+    id = struct.pack('>I', id).lstrip('\0')
+    if size is None:
+        size = '\x01' + struct.pack('>Q', len(data))[1:]
+    return id + size + data
+
+def uint(id, value):
+    return element(id, struct.pack('>Q', value).lstrip('\0') or '\0')
+
+def track_entry(num, codec, private='', encoding=None):
+    data = uint(mkvdemux.TRACK_NUMBER, num) + element(mkvdemux.CODEC_ID, codec)
+    if private:
+        data += element(mkvdemux.CODEC_PRIVATE, private)
+    if encoding:
+        algo, settings = encoding
+        compression = uint(mkvdemux.CONTENT_COMP_ALGO, algo)
+        if settings:
+            compression += element(mkvdemux.CONTENT_COMP_SETTINGS, settings)
+        data += element(mkvdemux.CONTENT_ENCODINGS,
+                    element(mkvdemux.CONTENT_ENCODING,
+                        element(mkvdemux.CONTENT_COMPRESSION, compression)))
+    return element(mkvdemux.TRACK_ENTRY, data)
+
+def block(track, timecode, data, duration=None):
+    data = chr(0x80 | track) + struct.pack('>hB', timecode, 0) + data
+    if duration is None:
+        return element(mkvdemux.SIMPLE_BLOCK, data)
+    return element(mkvdemux.BLOCK_GROUP, element(mkvdemux.BLOCK, data) +
+                                         uint(mkvdemux.BLOCK_DURATION, duration))
+
+def cluster(timecode, blocks, unknown_size=False):
+    data = uint(mkvdemux.TIMECODE, timecode) + ''.join(blocks)
+    return element(mkvdemux.CLUSTER, data, unknown_size and UNKNOWN_SIZE or None)
+
+def matroska(clusters, entries=None, timecode_scale=1000000):
+    """ Return a Matroska file with the tracks of TRACKS, whose clusters
+        each hold a video frame and the subs of the next second. """
+    if entries is None:
+        entries = [track_entry(1, 'V_MPEG4/ISO/AVC'),
+                   track_entry(2, 'S_TEXT/UTF8'),
+                   track_entry(3, 'S_TEXT/ASS', ASS_HEADER)]
+    return element(mkvdemux.EBML, uint(0x4282, 1)) + \
+           element(mkvdemux.SEGMENT,
+                   element(mkvdemux.INFO, uint(mkvdemux.TIMECODE_SCALE,
+                                               timecode_scale)) +
+                   element(mkvdemux.TRACKS, ''.join(entries)) +
+                   ''.join(clusters),
+                   UNKNOWN_SIZE)
+
+def sub_clusters(count):
+    return [cluster(i * 1000, [block(1, 0, 'frame' * 100),
+                               block(2, 500, 'Line %d\r\nmore' % i, 1200),
+                               block(3, 500, '%d,0,Default,,0,0,0,,Event %d' % (i, i), 1200)])
+                for i in xrange(count)]
+
+def expected_srt(count):
+    return ''.join(['%d\n00:00:%02d,500 --> 00:00:%02d,700\nLine %d\nmore\n\n'
+                        % (i + 1, i, i + 1, i) for i in xrange(count)])
+
+def expected_ass(count):
+    return ASS_HEADER + ''.join([
+        'Dialogue: 0,0:00:%02d.50,0:00:%02d.70,Default,,0,0,0,,Event %d\n'
+            % (i, i + 1, i) for i in xrange(count)])
+
+
+class DemuxTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'video.mkv')
+    
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+    
+    def demux(self, data, tracknum):
+        open(self.path, 'wb').write(data)
+        out = open(os.path.join(self.dir, 'out'), 'wb')
+        mkvdemux.SubtitleDemuxer(open(self.path, 'rb'), tracknum).demux(out)
+        out.close()
+        return open(os.path.join(self.dir, 'out'), 'rb').read()
+    
+    def test_srt_and_ass(self):
+        data = matroska(sub_clusters(3))
+        self.assertEqual(self.demux(data, 2), expected_srt(3))
+        self.assertEqual(self.demux(data, 3), expected_ass(3))
+    
+    def test_unknown_size_clusters(self):
+        data = matroska([cluster(i * 1000, [block(2, 500, 'Line %d\r\nmore' % i, 1200)],
+                                 unknown_size=True) for i in xrange(3)])
+        self.assertEqual(self.demux(data, 2), expected_srt(3))
+    
+    def test_timecode_scale(self):
+        data = matroska([cluster(100, [block(2, 50, 'Line 1\r\nmore', 120)])],
+                        timecode_scale=10000000)
+        self.assertEqual(self.demux(data, 2),
+                         '1\n00:00:01,500 --> 00:00:02,700\nLine 1\nmore\n\n')
+    
+    def test_compressed_tracks(self):
+        for encoding, encode in (((mkvdemux.ZLIB, ''), zlib.compress),
+                                 ((mkvdemux.HEADER_STRIPPING, 'Li'), lambda d: d[2:])):
+            entries = [track_entry(1, 'V_MPEG4/ISO/AVC'),
+                       track_entry(2, 'S_TEXT/UTF8', encoding=encoding)]
+            clusters = [cluster(i * 1000, [block(2, 500, encode('Line %d\r\nmore' % i), 1200)])
+                            for i in xrange(2)]
+            self.assertEqual(self.demux(matroska(clusters, entries), 2),
+                             expected_srt(2))
+    
+    def test_unsupported(self):
+        data = matroska(sub_clusters(1))
+        self.assertRaises(ValueError, self.demux, data, 1)
+        self.assertRaises(ValueError, self.demux, data, 4)
+        self.assertRaises(ValueError, self.demux, 'not matroska', 2)
+        self.assertRaises(ValueError, self.demux, data[:-10], 2)
+
+
+class SubsTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        subtitlefs.CACHE_DIR = os.path.join(self.dir, 'cache')
+        subtitlefs.TEMP_DIR = os.path.join(subtitlefs.CACHE_DIR, subtitlefs.TEMP_NAME)
+        os.makedirs(subtitlefs.TEMP_DIR)
+        self.fullpath = os.path.join(subtitlefs.CACHE_DIR, 'video.srt')
+    
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+    
+    def start_reading(self, file, size, offset):
+        """ Read from file in a thread, returning the thread and a list to
+            which the result is added. """
+        result = []
+        t = threading.Thread(target=lambda: result.append(file.read(size, offset)))
+        t.setDaemon(True)
+        t.start()
+        return t, result
+
+
+class ExtractionTest(SubsTest):
+    def test_registry(self):
+        extraction, started = subtitlefs.Extraction.begin(self.fullpath)
+        self.assertTrue(started)
+        self.assertEqual(subtitlefs.Extraction.begin(self.fullpath + '/.'),
+                         (extraction, False))
+        self.assertTrue(subtitlefs.Extraction.get(self.fullpath) is extraction)
+        
+        open(extraction.partpath, 'w').write('abc')
+        self.assertEqual(extraction.size(), 3)
+        self.assertTrue(extraction.wait_for(3))
+        extraction.finish()
+        self.assertTrue(extraction.done.isSet())
+        self.assertFalse(os.path.exists(extraction.partpath))
+        self.assertEqual(subtitlefs.Extraction.get(self.fullpath), None)
+        self.assertFalse(extraction.wait_for(4))
+        self.assertEqual(extraction.size(), 0)
+
+
+class ProgressiveFileTest(SubsTest):
+    def setUp(self):
+        SubsTest.setUp(self)
+        self.extraction = subtitlefs.Extraction.begin(self.fullpath)[0]
+        self.file = subtitlefs.ProgressiveFile(self.extraction)
+    
+    def tearDown(self):
+        if not self.extraction.done.isSet():
+            self.extraction.finish()
+        SubsTest.tearDown(self)
+    
+    def test_partial_reads(self):
+        part = open(self.extraction.partpath, 'wb')
+        t, result = self.start_reading(self.file, 100, 0)
+        time.sleep(0.2)
+        self.assertEqual(result, [])
+        
+        part.write('first')
+        part.flush()
+        t.join(1)
+        self.assertEqual(result, ['first'])
+        self.assertEqual(self.file.read(100, 2), 'rst')
+        
+        # Published with more than was written to the partial file
+        part.close()
+        subtitlefs.write_cache_file(self.fullpath, 'first second')
+        t, result = self.start_reading(self.file, 100, 5)
+        self.extraction.finish()
+        t.join(1)
+        self.assertEqual(result, [' second'])
+        self.assertEqual(self.file.read(100, 12), '')
+        self.file.close()
+    
+    def test_part_removed_before_published(self):
+        open(self.extraction.partpath, 'wb').write('first')
+        self.assertEqual(self.file.read(100, 0), 'first')
+        os.unlink(self.extraction.partpath)
+        
+        t, result = self.start_reading(self.file, 100, 0)
+        time.sleep(0.2)
+        self.assertEqual(result, [])
+        subtitlefs.write_cache_file(self.fullpath, 'first second')
+        self.extraction.finish()
+        t.join(1)
+        self.assertEqual(result, ['first second'])
+        self.file.close()
+    
+    def test_failed_extraction(self):
+        open(self.extraction.partpath, 'wb').write('first')
+        self.extraction.finish()
+        self.assertEqual(self.file.read(100, 0), '')
+
+
+class GatedFile(object):
+    """ A file whose reads past gate_offset block until gate is set. """
+    
+    def __init__(self, path, gate_offset, gate):
+        self.file = open(path, 'rb')
+        self.gate_offset = gate_offset
+        self.gate = gate
+    
+    def read(self, size=-1):
+        if self.file.tell() + max(size, 1) > self.gate_offset:
+            self.gate.wait()
+        return self.file.read(size)
+    
+    def __getattr__(self, attr):
+        return getattr(self.file, attr)
+
+
+class ExtractTest(SubsTest):
+    def setUp(self):
+        SubsTest.setUp(self)
+        self.mkvpath = os.path.join(self.dir, 'video.mkv')
+        self.fullpath = os.path.join(subtitlefs.CACHE_DIR,
+                                     self.mkvpath.lstrip('/')[:-len('.mkv')] + '.srt')
+        self.clusters = sub_clusters(4)
+        open(self.mkvpath, 'wb').write(matroska(self.clusters))
+        self.info = subtitlefs.MkvFile.info
+        subtitlefs.MkvFile.info = lambda self, ignore_errors=True: TRACKS
+    
+    def tearDown(self):
+        subtitlefs.MkvFile.info = self.info
+        SubsTest.tearDown(self)
+    
+    def test_extract(self):
+        mkv = subtitlefs.MkvFile(self.mkvpath)
+        self.assertEqual(mkv.extract(2), expected_srt(4))
+        self.assertEqual(mkv.extract(3), expected_ass(4))
+        self.assertEqual(os.listdir(subtitlefs.TEMP_DIR), [])
+    
+    def test_reads_return_before_extraction_ends(self):
+        # Hold up demuxing after the first two clusters
+        gate = threading.Event()
+        gate_offset = os.path.getsize(self.mkvpath) - len(''.join(self.clusters[2:]))
+        demux = subtitlefs.MkvFile.demux
+        def gated_demux(mkv, tracknum, path):
+            out = open(path, 'wb')
+            mkvdemux.SubtitleDemuxer(GatedFile(mkv.path, gate_offset, gate),
+                                     tracknum).demux(out)
+            out.close()
+        subtitlefs.MkvFile.demux = gated_demux
+        try:
+            extraction = subtitlefs.start_extraction(self.mkvpath, self.fullpath, 'eng')
+            file = subtitlefs.ProgressiveFile(extraction)
+            self.assertEqual(file.read(4096, 0), expected_srt(2))
+            self.assertFalse(extraction.done.isSet())
+            
+            t, result = self.start_reading(file, 4096, len(expected_srt(2)))
+            gate.set()
+            t.join(5)
+            self.assertEqual(result, [expected_srt(4)[len(expected_srt(2)):]])
+            subtitlefs.EXTRACTION_POOL.wait_idle()
+            self.assertTrue(extraction.done.isSet())
+            self.assertEqual(subtitlefs.open_cache_file(self.fullpath).read(4096),
+                             expected_srt(4))
+            self.assertEqual(file.read(4096, len(expected_srt(4))), '')
+        finally:
+            gate.set()
+            subtitlefs.MkvFile.demux = demux
+
+
+class ExtractionPoolTest(unittest.TestCase):
+    def setUp(self):
+        self.extract = subtitlefs.SubtitleExtractorThread.extract_and_cache_subs
+        self.lock = threading.Lock()
+        self.running = []
+        self.max_running = 0
+        self.calls = []
+        self.release = threading.Event()
+        def extract(mkvpath, lang, logger=None):
+            with self.lock:
+                self.calls.append(mkvpath)
+                self.running.append(mkvpath)
+                self.max_running = max(self.max_running, len(self.running))
+            self.release.wait()
+            with self.lock:
+                self.running.remove(mkvpath)
+        subtitlefs.SubtitleExtractorThread.extract_and_cache_subs = staticmethod(extract)
+    
+    def tearDown(self):
+        subtitlefs.SubtitleExtractorThread.extract_and_cache_subs = staticmethod(self.extract)
+    
+    def test_bounded_and_merged(self):
+        pool = subtitlefs.ExtractionPool(num_threads=2)
+        events = [pool.submit('video%d.mkv' % i, 'eng') for i in xrange(5)]
+        self.assertTrue(pool.submit('video0.mkv', 'eng') is events[0])
+        time.sleep(0.2)
+        self.assertEqual(len(self.running), 2)
+        
+        idle = threading.Thread(target=pool.wait_idle)
+        idle.setDaemon(True)
+        idle.start()
+        time.sleep(0.1)
+        self.assertTrue(idle.isAlive())
+        
+        self.release.set()
+        idle.join(5)
+        self.assertFalse(idle.isAlive())
+        self.assertTrue(all([e.isSet() for e in events]))
+        self.assertEqual(sorted(self.calls), ['video%d.mkv' % i for i in xrange(5)])
+        self.assertEqual(self.max_running, 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,117 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# Check that several processes sharing one cache directory extract each
+# subtitle track only once. Run with: python test_sharedcache.py
+# Copyright 2011 crass <crass@berlios.de>
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#   1. Redistributions of source code must retain the above copyright notice,
+#      this list of conditions and the following disclaimer.
+#   2. Redistributions in binary form must reproduce the above copyright notice,
+#      this list of conditions and the following disclaimer in the documentation
+#      and/or other materials provided with the distribution.
+#   3. The name of the author may not be used to endorse or promote products
+#      derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR ``AS IS'' AND ANY EXPRESS OR IMPLIED
+# WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO
+# EVENT SHALL THE AUTHOR BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS;
+# OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR
+# OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+# ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import multiprocessing
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+import subtitlefs
+
+NUM_PROCESSES = 6
+TRACKS = [
+    {'type': 'video', 'codec ID': 'V_MPEG4/ISO/AVC'},
+    {'type': 'subtitles', 'codec ID': 'S_TEXT/UTF8'},
+    {'type': 'subtitles', 'codec ID': 'S_TEXT/ASS'},
+]
+
+
+def fake_info(self, ignore_errors=True):
+    return TRACKS
+
+def fake_extract(self, tracknum, tmppath=None):
+    # Record each extraction in a file shared by all the processes
+    f = open(os.path.join(os.path.dirname(self.path), 'extractions'), 'a')
+    f.write('%s\n' % tracknum)
+    f.close()
+    time.sleep(0.5)
+    return 'track %s\n' % tracknum
+
+def extract(cachedir, mkvpath):
+    subtitlefs.CACHE_DIR = cachedir
+    subtitlefs.TEMP_DIR = os.path.join(cachedir, subtitlefs.TEMP_NAME)
+    subtitlefs.CACHE_SHARED = True
+    subtitlefs.CacheLease.POLL_SECS = 0.05
+    subtitlefs.MkvFile.info = fake_info
+    subtitlefs.MkvFile.extract = fake_extract
+    subtitlefs.SubtitleExtractorThread.extract_and_cache_subs(mkvpath, 'eng')
+
+
+class SharedCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.cachedir = os.path.join(self.dir, 'cache')
+        self.mkvpath = os.path.join(self.dir, 'video.mkv')
+        open(self.mkvpath, 'w').close()
+    
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+    
+    def test_each_track_extracted_once(self):
+        processes = [multiprocessing.Process(target=extract,
+                                             args=(self.cachedir, self.mkvpath))
+                        for i in xrange(NUM_PROCESSES)]
+        for p in processes:
+            p.start()
+        for p in processes:
+            p.join()
+            self.assertEqual(p.exitcode, 0)
+        
+        extractions = open(os.path.join(self.dir, 'extractions')).read().split()
+        self.assertEqual(sorted(extractions), ['2', '3'])
+        
+        base = os.path.join(self.cachedir, self.mkvpath.lstrip('/'))[:-len('.mkv')]
+        for ext, tracknum in (('srt', 2), ('ass', 3)):
+            f = subtitlefs.CacheFile('%s.%s' % (base, ext))
+            self.assertEqual(f.read(100), 'track %s\n' % tracknum)
+            f.close()
+        self.assertEqual([n for n in os.listdir(os.path.dirname(base))
+                            if n.endswith('.lock')], [])
+    
+    def test_release_keeps_lease_taken_over(self):
+        path = os.path.join(self.dir, 'sub.srt')
+        lease = subtitlefs.CacheLease(path)
+        self.assertTrue(lease.acquire())
+        
+        # Another daemon breaks our lease as stale and takes it
+        os.utime(lease.path, (0, 0))
+        other = subtitlefs.CacheLease(path)
+        self.assertFalse(other.acquire())
+        self.assertTrue(other.acquire())
+        
+        lease.release()
+        self.assertTrue(other.is_owned())
+        other.release()
+        self.assertFalse(os.path.exists(other.path))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,169 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# Check the track index gives the same results as looking tracks up in the
+# info of each video, and forgets videos which are gone.
+# Run with: python test_trackindex.py
+# Copyright 2011 crass <crass@berlios.de>
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#   1. Redistributions of source code must retain the above copyright notice,
+#      this list of conditions and the following disclaimer.
+#   2. Redistributions in binary form must reproduce the above copyright notice,
+#      this list of conditions and the following disclaimer in the documentation
+#      and/or other materials provided with the distribution.
+#   3. The name of the author may not be used to endorse or promote products
+#      derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR ``AS IS'' AND ANY EXPRESS OR IMPLIED
+# WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO
+# EVENT SHALL THE AUTHOR BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS;
+# OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR
+# OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+# ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import subtitlefs
+
+LANGS = ('eng', 'fre', 'ger')
+VIDEOS = [
+    [],
+    [{'type': 'video', 'codec ID': 'V_MPEG4/ISO/AVC'},
+     {'type': 'audio', 'codec ID': 'A_AC3', 'language': 'eng'}],
+    [{'type': 'video', 'codec ID': 'V_MPEG4/ISO/AVC'},
+     {'type': 'subtitles', 'codec ID': 'S_TEXT/UTF8'},
+     {'type': 'subtitles', 'codec ID': 'S_TEXT/ASS', 'language': 'eng'},
+     {'type': 'subtitles', 'codec ID': 'S_TEXT/UTF8', 'language': 'fre'}],
+    [{'type': 'subtitles', 'codec ID': 'S_TEXT/UTF8', 'language': 'fre'},
+     {'type': 'subtitles', 'codec ID': 'S_VOBSUB', 'language': 'eng'},
+     {'type': 'subtitles', 'codec ID': 'S_TEXT/UTF8', 'language': 'eng'},
+     {'type': 'subtitles', 'codec ID': 'S_TEXT/UTF8', 'language': 'eng'},
+     {'type': 'subtitles', 'codec ID': 'S_TEXT/SSA', 'language': 'ger'},
+     {'type': 'video', 'codec ID': 'V_MPEG4/ISO/AVC'}],
+]
+
+
+def old_get_subtitle_track_num(info, stype, lang):
+    for i, trackinfo in enumerate(info):
+        if trackinfo['type'] == 'subtitles' \
+                and trackinfo['codec ID'] == subtitlefs.MkvFile.SUBEXT_MIME_MAP.get(stype, None) \
+                and trackinfo.get('language', subtitlefs.DEFAULT_LANG) == lang:
+            return i+1
+    return 0
+
+def old_subtitle_tracks(info, lang):
+    return [(i+1, trackinfo['codec ID']) for i, trackinfo in enumerate(info)
+                if trackinfo['type'] == 'subtitles'
+                    and trackinfo.get('language', subtitlefs.DEFAULT_LANG) == lang]
+
+
+class FakePopen(object):
+    """ Stands in for mkvextract, writing the output path to the output. """
+    pid = None
+    
+    def __init__(self, cmd, **kwargs):
+        path = cmd[-1].split(':', 1)[1]
+        open(path, 'w').write(path)
+        self.stdout = open(os.devnull)
+
+
+class TrackIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        subtitlefs.TEMP_DIR = os.path.join(self.dir, 'tmp')
+        self.index = subtitlefs.TRACK_INDEX = subtitlefs.TrackIndex()
+        self.infos = {}
+        self.info_calls = []
+        self.paths = []
+        for i, info in enumerate(VIDEOS):
+            path = os.path.join(self.dir, 'video%d.mkv' % i)
+            open(path, 'w').close()
+            self.infos[path] = info
+            self.paths.append(path)
+        
+        self.saved = (subtitlefs.MkvFile.info, subtitlefs.MkvFile.demux,
+                      subtitlefs.MkvFile._cleanup_child_process,
+                      subtitlefs.subprocess.Popen)
+        def info(mkv, ignore_errors=True):
+            self.info_calls.append(mkv.path)
+            return self.infos[mkv.path]
+        def demux(mkv, tracknum, path):
+            open(path, 'w').write(path)
+        subtitlefs.MkvFile.info = info
+        subtitlefs.MkvFile.demux = demux
+        subtitlefs.MkvFile._cleanup_child_process = lambda mkv, p: None
+        subtitlefs.subprocess.Popen = FakePopen
+    
+    def tearDown(self):
+        (subtitlefs.MkvFile.info, subtitlefs.MkvFile.demux,
+         subtitlefs.MkvFile._cleanup_child_process,
+         subtitlefs.subprocess.Popen) = self.saved
+        shutil.rmtree(self.dir)
+    
+    def test_same_as_info(self):
+        for path in self.paths:
+            info = self.infos[path]
+            mkv = subtitlefs.MkvFile(path)
+            for lang in LANGS:
+                for stype in subtitlefs.MkvFile.SUBEXT_MIME_MAP.keys() + ['idx']:
+                    self.assertEqual(mkv.get_subtitle_track_num(stype, lang),
+                                     old_get_subtitle_track_num(info, stype, lang))
+                self.assertEqual([(t.num, t.codec) for t in mkv.subtitle_tracks(lang)],
+                                 old_subtitle_tracks(info, lang))
+            
+            for i, trackinfo in enumerate(info):
+                subext = subtitlefs.MkvFile.SUBMIME_EXT_MAP.get(trackinfo['codec ID'])
+                if subext:
+                    # The output path is named after the sub format
+                    data = mkv.extract(i+1)
+                    self.assertTrue(data.endswith('.' + subext), data)
+        
+        # Each video was only run through mkvinfo once
+        self.assertEqual(sorted(self.info_calls), sorted(self.paths))
+        self.assertEqual(os.listdir(subtitlefs.TEMP_DIR), [])
+    
+    def test_reindexed_when_changed(self):
+        path = self.paths[2]
+        mkv = subtitlefs.MkvFile(path)
+        self.assertEqual(mkv.get_subtitle_track_num('srt', 'eng'), 2)
+        self.infos[path] = self.infos[path][1:]
+        self.assertEqual(mkv.get_subtitle_track_num('srt', 'eng'), 2)
+        os.utime(path, (0, 0))
+        self.assertEqual(mkv.get_subtitle_track_num('srt', 'eng'), 1)
+    
+    def test_forgets_deleted_videos(self):
+        for path in self.paths:
+            self.index.tracks(subtitlefs.MkvFile(path))
+        outside = '/elsewhere/video.mkv'
+        self.index.videos[outside] = (0, ())
+        
+        os.unlink(self.paths[0])
+        self.assertEqual(self.index.tracks(subtitlefs.MkvFile(self.paths[0])), ())
+        self.assertFalse(self.paths[0] in self.index.videos)
+        
+        # Renamed, as found by a scan
+        self.index.prune(self.dir, set(self.paths[2:]))
+        self.assertEqual(sorted(self.index.videos), sorted(self.paths[2:] + [outside]))
+    
+    def test_bounded(self):
+        self.index.MAX_VIDEOS = 2
+        for path in self.paths:
+            self.index.tracks(subtitlefs.MkvFile(path))
+            self.assertTrue(path in self.index.videos)
+        self.assertEqual(len(self.index.videos), 2)
+        self.index.tracks(subtitlefs.MkvFile(self.paths[-1]))
+        self.assertEqual(len(self.index.videos), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()